@@ -0,0 +1,89 @@
+import numpy as np, argparse, json, os, platform, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import synthetic_data
+from run_benchmarks import model_names, weight_types, new_model, fit_quietly, recovery_error
+
+#Compares the optimizer backends (see optimizer_backend in model_building.py) on the same synthetic datasets.
+#Every dataset is fitted with each backend and the report gives, per fit, the wall time (best of --repeats),
+#the optimizer's own evaluation count, the residual evaluations actually made (which also counts those spent
+#on finite difference gradients), the final weighted sum of squares and how well the known parameters were
+#recovered, followed by totals per backend:
+#
+#   python benchmarks/compare_backends.py --output backends.json
+
+backends = ['l-bfgs-b', 'least-squares']
+
+
+def compare_backends(fit_sizes, search_types, gradient_types, repeats):
+  results = {}
+  #Fit once with each backend first so that importing scipy isn't charged to whichever fit comes first.
+  for backend in backends:
+    current_model = new_model(0, 0, synthetic_data.make_dataset(0))
+    current_model.optimizer_backend = backend
+    fit_quietly(current_model)
+  print('%-44s %-14s %9s %7s %7s %14s %9s  %s'%('fit', 'backend', 'ms', 'nfev', 'resid', 'objective',
+                                               'recovery', 'status'))
+  for model_type in (0, 1, 2):
+    params = synthetic_data.default_params[model_type]
+    for size in fit_sizes:
+      data = synthetic_data.make_dataset(model_type, num_points=size, noise=0.02)
+      x, y = data['total'].values, data['free'].values
+      for weight_type in weight_types:
+        for search_type in search_types:
+          for gradient_type in gradient_types:
+            name = '%s_fit/%s/%s/n=%s/w=%s'%(model_names[model_type], search_type, gradient_type, size, weight_type)
+            for backend in backends:
+              best = None
+              for _ in range(repeats):
+                current_model = new_model(model_type, weight_type, data)
+                current_model.search_type = search_type
+                current_model.gradient_type = gradient_type
+                current_model.optimizer_backend = backend
+                current_model.instrumentation = True
+                start = time.perf_counter()
+                error_code = fit_quietly(current_model)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+              resid = getattr(current_model, '%s_resid'%model_names[model_type])
+              result = {'seconds':best, 'status':error_code,
+                        'function_evaluations':current_model.optimizer_stats.get('function_evaluations'),
+                        'iterations':current_model.optimizer_stats.get('iterations'),
+                        'residual_evaluations':current_model.fit_stats.counters.get('residual_evaluations', 0),
+                        'objective':float(resid(current_model.params, x, y)),
+                        'recovery_error':recovery_error(current_model, params)}
+              results['%s/%s'%(name, backend)] = result
+              print('%-44s %-14s %9.1f %7s %7s %14.6g %9.3g  %s'%(name, backend, 1000 * best,
+                    result['function_evaluations'], result['residual_evaluations'], result['objective'],
+                    result['recovery_error'], 'ok' if error_code == '0' else 'error'))
+  print('\n%-14s %9s %9s %9s %16s'%('backend', 'total ms', 'nfev', 'resid', 'best objective'))
+  for backend in backends:
+    mine = {name[:-len(backend) - 1]:result for name, result in results.items() if name.endswith('/' + backend)}
+    others = [{name[:-len(other) - 1]:result for name, result in results.items() if name.endswith('/' + other)}
+              for other in backends if other != backend]
+    #A fit counts as reaching the best objective if no other backend got more than 1e-6 (relatively) lower.
+    best_count = sum(all(result['objective'] <= other[name]['objective'] * (1 + 1e-6) for other in others)
+                     for name, result in mine.items())
+    print('%-14s %9.1f %9s %9s %16s'%(backend, 1000 * sum(result['seconds'] for result in mine.values()),
+          sum(result['function_evaluations'] or 0 for result in mine.values()),
+          sum(result['residual_evaluations'] for result in mine.values()), '%s of %s fits'%(best_count, len(mine))))
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the optimizer backends of the protein binding fitter.')
+  parser.add_argument('--output', default=None, help='Write results to this JSON file')
+  parser.add_argument('--fit-sizes', type=int, nargs='+', default=[14, 50], help='Dataset sizes to fit')
+  parser.add_argument('--search-types', nargs='+', default=['multistart', 'grid'], choices=['multistart', 'grid'])
+  parser.add_argument('--gradient-types', nargs='+', default=['analytic'], choices=['analytic', 'numerical'])
+  parser.add_argument('--repeats', type=int, default=3, help='Fits per dataset and backend (best time is kept)')
+  parser.add_argument('--quick', action='store_true', help='Multistart fits of 14 points only, for a fast smoke test')
+  args = parser.parse_args()
+  if args.quick:
+    args.fit_sizes, args.search_types, args.repeats = [14], ['multistart'], 1
+  results = compare_backends(args.fit_sizes, args.search_types, args.gradient_types, args.repeats)
+  if args.output is not None:
+    output = {'metadata':{'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform(),
+                          'time':time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results':results}
+    with open(args.output, 'w') as output_file:
+      json.dump(output, output_file, indent=1)
@@ -0,0 +1,77 @@
+import argparse, json, os, platform, subprocess, sys, tempfile, time
+
+#Import-time benchmark. Each entry point is imported in a fresh interpreter (so nothing is already cached in
+#sys.modules) and the time taken by the import statement is recorded, best of --repeats runs, along with
+#which of the heavy optional dependencies the import dragged in. The interpreters are started from a
+#temporary directory to make sure nothing relies on being run from the top of the repository. Results are
+#written and compared just like run_benchmarks.py:
+#
+#   python benchmarks/import_time.py --output imports_before.json
+#   ... make changes ...
+#   python benchmarks/import_time.py --output imports_after.json --compare imports_before.json
+
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+import_targets = {'headless/model_building':'import model_building',
+                  'headless/model_io':'import model_io',
+                  'headless/pk_calc':'import pk_calc',
+                  'headless/batch_fitting':'import batch_fitting',
+                  'gui/pb_fitter':'import pb_fitter'}
+heavy_modules = ['PyQt5', 'matplotlib', 'matplotlib.pyplot', 'sklearn', 'pandas', 'numdifftools', 'scipy.optimize',
+                 'scipy.stats']
+timing_code = ('import sys, time, json\n'
+               'sys.path.insert(0, %r)\n'
+               'start = time.perf_counter()\n'
+               '%s\n'
+               'seconds = time.perf_counter() - start\n'
+               'print(json.dumps({"seconds":seconds, "loaded":[name for name in %r if name in sys.modules]}))\n')
+
+
+def time_import(statement, repeats = 5):
+  environment = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+  best = None
+  for _ in range(repeats):
+    run = subprocess.run([sys.executable, '-c', timing_code%(scripts_dir, statement, heavy_modules)],
+                         capture_output=True, text=True, env=environment, cwd=tempfile.gettempdir())
+    if run.returncode != 0:
+      return {'error':run.stderr.strip().splitlines()[-1]}
+    result = json.loads(run.stdout.strip().splitlines()[-1])
+    if best is None or result['seconds'] < best['seconds']:
+      best = result
+  return best
+
+
+def run_import_benchmarks(repeats):
+  results = {}
+  for name, statement in import_targets.items():
+    result = time_import(statement, repeats)
+    if 'error' in result:
+      print('%-30s failed: %s'%(name, result['error']))
+      continue
+    results[name] = result
+    print('%-30s %9.1f ms   loads: %s'%(name, 1000 * result['seconds'], ', '.join(result['loaded']) or '-'))
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Time the imports of the protein binding fitter entry points.')
+  parser.add_argument('--output', default=None, help='Write results to this JSON file')
+  parser.add_argument('--compare', default=None, help='Baseline JSON file to compare against')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Fractional slowdown that counts as a regression (default 0.25)')
+  parser.add_argument('--repeats', type=int, default=5, help='Fresh interpreters per import (best is kept)')
+  args = parser.parse_args()
+  results = run_import_benchmarks(args.repeats)
+  output = {'metadata':{'python':platform.python_version(), 'platform':platform.platform(),
+                        'time':time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results':results}
+  if args.output is not None:
+    with open(args.output, 'w') as output_file:
+      json.dump(output, output_file, indent=1)
+  if args.compare is not None:
+    import run_benchmarks
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)['results']
+    regressions = run_benchmarks.compare_results(results, baseline, args.threshold)
+    print('\n%s regression(s)'%len(regressions))
+    if regressions:
+      sys.exit(1)
@@ -0,0 +1,184 @@
+import numpy as np, argparse, contextlib, io, json, os, platform, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import model_building, synthetic_data
+
+#Benchmarks for the fitting hot paths. Each benchmark times one function on synthetic data and the results
+#are written as JSON so that they can be kept as a baseline and compared against later runs, e.g.
+#
+#   python benchmarks/run_benchmarks.py --output baseline.json
+#   ... make changes ...
+#   python benchmarks/run_benchmarks.py --output new.json --compare baseline.json
+#
+#The compare mode flags every benchmark that got slower by more than --threshold (as a fraction) and
+#exits with status 1 if there were any. Timings of a fraction of a millisecond jitter by far more than 25%
+#between identical runs, so a slowdown also has to exceed --min-delta seconds and the noise measured from
+#the repeats (see compare_results) before it counts. Fits are timed like everything else (best of repeats,
+#see time_call) and each also records how well the known parameters were recovered.
+
+weight_types = [0, 1, 2, 3]
+model_names = {0:'onebind', 1:'twobind', 2:'threebind'}
+
+
+#Times func: it is called repeatedly until at least min_time has passed, that is done repeats times and
+#the best per-call time is kept, which is the least noisy estimate on a busy machine. The spread between the
+#best and the worst repeat is returned with it as a measure of how noisy the timing was.
+def time_call(func, min_time = 0.05, repeats = 3):
+  per_call = []
+  for _ in range(repeats):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+      func()
+      calls += 1
+      elapsed = time.perf_counter() - start
+      if elapsed >= min_time:
+        break
+    per_call.append(elapsed / calls)
+  return min(per_call), max(per_call) - min(per_call)
+
+
+def new_model(model_type, weight_type = 0, data = None):
+  current_model = model_building.protbind_model(model_type = model_type, weight_type = weight_type)
+  if data is not None:
+    current_model.associated_data = data
+  return current_model
+
+
+def fit_quietly(current_model):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return current_model.model_fit()
+
+
+#Largest relative error between fitted and true parameters, with the sites in order of increasing kd.
+def recovery_error(current_model, true_params):
+  num_params = len(current_model.model_associated_params[current_model.model_type])
+  fitted = current_model.sort_sites(current_model.params[np.newaxis, 0:num_params])[0]
+  truth = np.asarray([true_params[param] for param in current_model.model_associated_params[current_model.model_type]])
+  truth = current_model.sort_sites(truth[np.newaxis, :])[0]
+  return float(np.max(np.abs(fitted - truth) / truth))
+
+
+def run_benchmarks(sizes, fit_sizes, root_engines, min_time):
+  results = {}
+  def record(name, timing, **extra):
+    seconds, spread = timing
+    results[name] = dict(seconds=seconds, spread=spread, **extra)
+    print('%-60s %12.3f ms'%(name, 1000 * seconds))
+
+  for model_type in (0, 1, 2):
+    params = synthetic_data.default_params[model_type]
+    param_vector = np.asarray([params[param] for param in new_model(model_type).model_associated_params[model_type]])
+    for size in sizes:
+      data = synthetic_data.make_dataset(model_type, num_points=size)
+      x, y = data['total'].values, data['free'].values
+      for root_engine in (root_engines if model_type > 0 else ['-']):
+        current_model = new_model(model_type)
+        if root_engine != '-':
+          current_model.root_engine = root_engine
+        suffix = '' if root_engine == '-' else '/%s'%root_engine
+        predict = getattr(current_model, model_names[model_type])
+        record('%s/n=%s%s'%(model_names[model_type], size, suffix),
+               time_call(lambda: predict(x, param_vector), min_time))
+        for weight_type in weight_types:
+          current_model.weight_type = weight_type
+          resid = getattr(current_model, '%s_resid'%model_names[model_type])
+          resid_grad = getattr(current_model, '%s_resid_grad'%model_names[model_type])
+          record('%s_resid/n=%s/w=%s%s'%(model_names[model_type], size, weight_type, suffix),
+                 time_call(lambda: resid(param_vector, x, y), min_time))
+          record('%s_resid_grad/n=%s/w=%s%s'%(model_names[model_type], size, weight_type, suffix),
+                 time_call(lambda: resid_grad(param_vector, x, y), min_time))
+
+    for size in fit_sizes:
+      data = synthetic_data.make_dataset(model_type, num_points=size, noise=0.02)
+      x, y = data['total'].values, data['free'].values
+      for weight_type in weight_types:
+        for search_type in ('grid', 'multistart'):
+          #Every call fits a fresh model; the last one is kept for the status, recovery and the calc_error
+          #benchmarks below.
+          fits = []
+          def fit():
+            current_model = new_model(model_type, weight_type, data)
+            current_model.search_type = search_type
+            fits[:] = [current_model, fit_quietly(current_model)]
+          timing = time_call(fit, min_time)
+          current_model, error_code = fits
+          record('%s_fit/%s/n=%s/w=%s'%(model_names[model_type], search_type, size, weight_type),
+                 timing, status=error_code, recovery_error=recovery_error(current_model, params),
+                 function_evaluations=current_model.optimizer_stats.get('function_evaluations'))
+        resid = getattr(current_model, '%s_resid'%model_names[model_type])
+        for hessian_type in ('exact', 'gauss-newton', 'numerical'):
+          current_model.hessian_type = hessian_type
+          record('calc_error/%s/%s/n=%s/w=%s'%(model_names[model_type], hessian_type, size, weight_type),
+                 time_call(lambda: current_model.calc_error(x, y, resid), min_time))
+
+    current_model = new_model(model_type, 1, synthetic_data.make_dataset(model_type))
+    fit_quietly(current_model)
+    for size in sizes:
+      pk_concentrations = np.exp(np.random.default_rng(0).uniform(np.log(0.5), np.log(2000), size))
+      current_model.clear_lookup_table()
+      record('make_preds/%s/n=%s'%(model_names[model_type], size),
+             time_call(lambda: current_model.make_preds(pk_concentrations), min_time))
+      current_model.build_lookup_table(0.5, 2000)
+      record('make_preds/%s/lookup/n=%s'%(model_names[model_type], size),
+             time_call(lambda: current_model.make_preds(pk_concentrations), min_time))
+  return results
+
+
+#Compares two sets of results and returns the names of benchmarks that regressed. A benchmark regressed if it
+#is more than threshold (as a fraction) slower and the slowdown is larger than both min_delta seconds and the
+#noise. The noise is taken as noise_factor times the larger spread between repeats of the two runs, since
+#three back-to-back repeats vary less than separate runs do (baselines written before the spread was
+#recorded count as noiseless).
+def compare_results(results, baseline, threshold, min_delta = 0.0, noise_factor = 3.0):
+  regressions = []
+  print('\n%-60s %12s %12s %8s %10s'%('benchmark', 'baseline ms', 'current ms', 'ratio', 'noise ms'))
+  for name in sorted(set(results) & set(baseline)):
+    ratio = results[name]['seconds'] / baseline[name]['seconds']
+    noise = noise_factor * max(results[name].get('spread', 0.0), baseline[name].get('spread', 0.0))
+    slowdown = results[name]['seconds'] - baseline[name]['seconds']
+    flag = ''
+    if ratio > 1 + threshold and slowdown > max(min_delta, noise):
+      regressions.append(name)
+      flag = '  REGRESSION'
+    print('%-60s %12.3f %12.3f %8.2f %10.3f%s'%(name, 1000 * baseline[name]['seconds'],
+                                                 1000 * results[name]['seconds'], ratio, 1000 * noise, flag))
+  for name in sorted(results):
+    if 'recovery_error' in results[name] and name in baseline and \
+       results[name]['recovery_error'] > 2 * baseline[name]['recovery_error'] + 1e-3:
+      print('%s: parameter recovery error went from %.3g to %.3g'%(name, baseline[name]['recovery_error'],
+                                                                   results[name]['recovery_error']))
+      regressions.append(name)
+  return regressions
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the protein binding fitting hot paths.')
+  parser.add_argument('--output', default=None, help='Write results to this JSON file')
+  parser.add_argument('--compare', default=None, help='Baseline JSON file to compare against')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Fractional slowdown that counts as a regression (default 0.25)')
+  parser.add_argument('--min-delta', type=float, default=5e-4,
+                      help='Smallest slowdown in seconds that counts as a regression (default 5e-4)')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[14, 100, 1000, 10000],
+                      help='Dataset sizes for the model / residual / prediction benchmarks')
+  parser.add_argument('--fit-sizes', type=int, nargs='+', default=[14, 50],
+                      help='Dataset sizes for the fitting benchmarks')
+  parser.add_argument('--min-time', type=float, default=0.05, help='Minimum seconds to spend timing each benchmark')
+  parser.add_argument('--quick', action='store_true', help='Small sizes only, for a fast smoke test')
+  args = parser.parse_args()
+  if args.quick:
+    args.sizes, args.fit_sizes, args.min_time = [14, 1000], [14], 0.01
+  results = run_benchmarks(args.sizes, args.fit_sizes, model_building.root_engines, args.min_time)
+  output = {'metadata':{'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform(),
+                        'time':time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results':results}
+  if args.output is not None:
+    with open(args.output, 'w') as output_file:
+      json.dump(output, output_file, indent=1)
+  if args.compare is not None:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)['results']
+    regressions = compare_results(results, baseline, args.threshold, args.min_delta)
+    print('\n%s regression(s)'%len(regressions))
+    if regressions:
+      sys.exit(1)
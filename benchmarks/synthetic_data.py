@@ -0,0 +1,30 @@
+import numpy as np, pandas as pd, os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import rootfinding
+
+#Generates synthetic protein binding datasets from known parameters so we can time the fitting code on
+#datasets of any size and check that the fits recover the parameters we started from. Total concentrations
+#are spread evenly in log space between min_total and max_total, the exact free concentration is found for
+#each and multiplied by log-normal noise with the given standard deviation (0 gives noise-free data).
+
+default_params = {0:{'kd1':50.0, 'p1':200.0},
+                  1:{'kd1':10.0, 'p1':80.0, 'kd2':800.0, 'p2':250.0},
+                  2:{'kd1':0.5, 'p1':20.0, 'kd2':20.0, 'p2':150.0, 'kd3':2000.0, 'p3':400.0}}
+
+
+def make_dataset(model_type = 1, params = None, num_points = 14, noise = 0.05, min_total = 0.5,
+                 max_total = 2000.0, seed = 0):
+  if params is None:
+    params = default_params[model_type]
+  num_sites = model_type + 1
+  kds = [params['kd%s'%(site+1)] for site in range(num_sites)]
+  ps = [params['p%s'%(site+1)] for site in range(num_sites)]
+  total = np.exp(np.linspace(np.log(min_total), np.log(max_total), num_points))
+  free = rootfinding.solve_free_drug(total, kds, ps)
+  if noise > 0:
+    free = free * np.random.default_rng(seed).lognormal(0.0, noise, num_points)
+  return pd.DataFrame({'total':total, 'free':free})
+
+
+def write_dataset(filename, **kwargs):
+  make_dataset(**kwargs).to_csv(filename, header=False, index=False)
@@ -4,4 +4,5 @@ pip install scipy
 pip install numpy
 pip install numdifftools
 pip install ctypes
-pip install sklearn
+pip install pandas
+pip install pyarrow
@@ -0,0 +1,154 @@
+import numpy as np, pandas as pd, model_building, fit_cache, argparse, glob, os, time
+from concurrent.futures import ProcessPoolExecutor
+
+#This module lets us fit many protein binding datasets without the GUI, e.g. a whole compound library
+#across several species overnight on a server. Each dataset is a csv file with the same layout the GUI
+#expects (total concentration in the first column, free concentration in the second, no headers).
+#The fits are independent of one another so we simply farm them out over a process pool and collect
+#one row of results per dataset into a single table.
+
+model_type_names = {0:'one-site', 1:'two-site', 2:'three-site'}
+result_columns = ['dataset', 'path', 'model_type', 'weight_type', 'status', 'warning',
+                  'kd1', 'p1', 'kd2', 'p2', 'kd3', 'p3',
+                  'kd1_error', 'p1_error', 'kd2_error', 'p2_error', 'kd3_error', 'p3_error',
+                  'AIC', 'num_points', 'fit_time']
+
+#One fit cache per cache directory in each worker process, so repeated datasets handled by the same worker
+#are found in memory and the rest on disk.
+worker_caches = {}
+
+
+#Builds the list of fitting jobs. The source may be a directory (every csv in it is fitted using the
+#default model and weight type) or a manifest csv with a header row containing at least a 'path'
+#column and optionally 'dataset', 'model_type' and 'weight_type' columns which override the defaults
+#for that row. Relative paths in a manifest are taken relative to the manifest itself.
+def collect_jobs(source, model_type = 0, weight_type = 0):
+  jobs = []
+  if os.path.isdir(source):
+    for path in sorted(glob.glob(os.path.join(source, '*.csv'))):
+      jobs.append({'dataset':os.path.splitext(os.path.basename(path))[0], 'path':path,
+                   'model_type':model_type, 'weight_type':weight_type})
+    return jobs
+  manifest = pd.read_csv(source)
+  if 'path' not in manifest.columns:
+    raise ValueError('The manifest %s must contain a "path" column.'%source)
+  manifest_dir = os.path.dirname(os.path.abspath(source))
+  for _, row in manifest.iterrows():
+    path = str(row['path'])
+    if not os.path.isabs(path):
+      path = os.path.join(manifest_dir, path)
+    dataset = row['dataset'] if 'dataset' in manifest.columns and pd.notnull(row['dataset']) \
+              else os.path.splitext(os.path.basename(path))[0]
+    job_model_type = int(row['model_type']) if 'model_type' in manifest.columns and \
+                     pd.notnull(row['model_type']) else model_type
+    job_weight_type = int(row['weight_type']) if 'weight_type' in manifest.columns and \
+                      pd.notnull(row['weight_type']) else weight_type
+    jobs.append({'dataset':str(dataset), 'path':path, 'model_type':job_model_type,
+                 'weight_type':job_weight_type})
+  return jobs
+
+
+#Fits a single dataset. This runs inside a worker process so it must never raise; any problem is
+#reported through the status column instead so that one bad file doesn't take down the whole batch.
+def fit_dataset(job):
+  result = {column:np.nan for column in result_columns}
+  result.update({'dataset':job['dataset'], 'path':job['path'], 'model_type':job['model_type'],
+                 'weight_type':job['weight_type'], 'warning':''})
+  start_time = time.time()
+  try:
+    if job['model_type'] not in model_type_names:
+      raise ValueError('unknown model type %s'%job['model_type'])
+    if job['weight_type'] not in (0, 1, 2, 3):
+      raise ValueError('unknown weight type %s'%job['weight_type'])
+    current_model = model_building.protbind_model(model_type = job['model_type'],
+                                                  weight_type = job['weight_type'])
+    if job.get('root_engine') is not None:
+      current_model.root_engine = job['root_engine']
+    if job.get('optimizer_backend') is not None:
+      current_model.optimizer_backend = job['optimizer_backend']
+    current_model.instrumentation = job.get('log_stats', False)
+    if job.get('cache_dir') is not None:
+      if job['cache_dir'] not in worker_caches:
+        worker_caches[job['cache_dir']] = fit_cache.fit_cache(cache_dir = job['cache_dir'])
+      current_model.fit_cache = worker_caches[job['cache_dir']]
+    current_model.associated_data = pd.read_csv(job['path'], header=None)
+    current_model.associated_data.columns = ['total', 'free']
+    result['num_points'] = current_model.associated_data.shape[0]
+    error_code = current_model.model_fit()
+  except Exception as err:
+    result['status'] = 'error: %s'%err
+    result['fit_time'] = time.time() - start_time
+    return result
+  result['fit_time'] = time.time() - start_time
+  if error_code != '0':
+    result['status'] = 'error: %s'%error_code
+    return result
+  result['status'] = 'ok'
+  if current_model.fit_warning is not None:
+    result['warning'] = current_model.fit_warning
+  for param in current_model.model_associated_params[current_model.model_type]:
+    result[param] = current_model.params[current_model.param_ids[param]]
+    result['%s_error'%param] = current_model.param_errors[current_model.param_ids[param]]
+  result['AIC'] = current_model.AIC
+  if current_model.fit_cache is not None:
+    result['cache_hit'] = current_model.from_cache
+  if current_model.fit_stats is not None:
+    for name, value in current_model.fit_stats.summary().items():
+      result['stats_%s'%name] = value
+  return result
+
+
+#Fits every dataset listed by the source (see collect_jobs) and writes one consolidated results table
+#to output_file. With num_workers = 1 everything runs in this process, which is handy for debugging;
+#otherwise the jobs are spread over a process pool (num_workers = None uses every core). root_engine
+#optionally overrides the model's default two-site root engine ('eigen' or 'numpy') and optimizer_backend
+#its local optimizer ('l-bfgs-b' or 'least-squares'). With log_stats each fit is instrumented and its counts
+#and timings are added to the table as stats_* columns. With a cache_dir,
+#fit results are cached there (see fit_cache.py) so datasets already fitted with the same settings, in this
+#batch or an earlier one, are not fitted again; a cache_hit column says which ones came from the cache.
+def batch_fit(source, output_file = None, model_type = 0, weight_type = 0, num_workers = None,
+              root_engine = None, log_stats = False, cache_dir = None, optimizer_backend = None):
+  jobs = collect_jobs(source, model_type, weight_type)
+  for job in jobs:
+    job['root_engine'] = root_engine
+    job['log_stats'] = log_stats
+    job['cache_dir'] = cache_dir
+    job['optimizer_backend'] = optimizer_backend
+  if num_workers == 1 or len(jobs) <= 1:
+    results = [fit_dataset(job) for job in jobs]
+  else:
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+      results = list(executor.map(fit_dataset, jobs, chunksize=1))
+  stats_columns = sorted(set(column for result in results for column in result if column.startswith('stats_')))
+  cache_columns = ['cache_hit'] if cache_dir is not None else []
+  results = pd.DataFrame(results, columns=result_columns + cache_columns + stats_columns)
+  if output_file is not None:
+    results.to_csv(output_file, index=False)
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fit many protein binding datasets without the GUI.')
+  parser.add_argument('source', help='A directory of (total, free) csv files or a manifest csv with a path column')
+  parser.add_argument('output', help='Where to write the consolidated results csv')
+  parser.add_argument('--model-type', type=int, default=0, choices=sorted(model_type_names),
+                      help='0 = single binding site, 1 = two binding site, 2 = three binding site')
+  parser.add_argument('--weight-type', type=int, default=0, choices=[0, 1, 2, 3],
+                      help='0 = none, 1 = 1/C, 2 = 1/C^2, 3 = 1/C^3')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='Number of worker processes (default: one per core)')
+  parser.add_argument('--root-engine', default=None, choices=model_building.root_engines,
+                      help='Root engine for the two and three-site models (default: eigen if rootfinder.so is available; '
+                           'eigen is only offered if it is)')
+  parser.add_argument('--log-stats', action='store_true',
+                      help='Record counts and timings for each fit in the results table')
+  parser.add_argument('--cache-dir', default=None,
+                      help='Directory for cached fit results; datasets already fitted with the same settings are not refitted')
+  parser.add_argument('--optimizer-backend', default=None, choices=['l-bfgs-b', 'least-squares'],
+                      help='Local optimizer run from each start (default: l-bfgs-b)')
+  args = parser.parse_args()
+  start_time = time.time()
+  results = batch_fit(args.source, args.output, args.model_type, args.weight_type, args.workers,
+                      args.root_engine, args.log_stats, args.cache_dir, args.optimizer_backend)
+  print('Fitted %s datasets (%s ok) in %.1f s'%(results.shape[0], np.sum(results['status'] == 'ok'),
+                                                time.time() - start_time))
@@ -0,0 +1,115 @@
+import numpy as np, model_building, itertools
+from concurrent.futures import ProcessPoolExecutor
+
+#Bootstrap confidence intervals for a fitted model. The uncertainties from calc_error come from inverting the
+#Hessian, which is unreliable when the two-site problem is ill-conditioned, so as an alternative we refit many
+#resampled copies of the dataset and take percentiles of the refitted parameters and of the predicted free
+#drug curve. Resampling is either by cases (draw (total, free) pairs with replacement) or by residuals (add
+#residuals drawn with replacement to the fitted curve). The residuals are resampled on the weighted scale
+#sqrt(w) * (y - fitted) and unweighted again at the point they are added to, so that with e.g. 1/C**2
+#weighting a large residual from a high concentration doesn't land on a low one. Since a resampled dataset
+#is close to the original, each refit is a polish_fit warm-started from the base fit rather than a full
+#multistart search; replicates whose refit doesn't converge are counted as failed.
+#
+#Replicates are handed out in fixed blocks of block_size, each with its own child of one SeedSequence, so the
+#results depend only on the seed and not on how many worker processes are used.
+
+block_size = 100
+
+
+#Refits one block of resampled datasets. This runs in a worker process.
+def bootstrap_block(job):
+  pb_model = model_building.protbind_model(model_type = job['model_type'], weight_type = job['weight_type'])
+  pb_model.root_engine = job['root_engine']
+  x, y, base_params = job['x'], job['y'], job['base_params']
+  num_params = base_params.shape[0]
+  full_params = np.zeros(pb_model.params.shape)
+  full_params[0:num_params] = base_params
+  pb_model.params = full_params
+  fitted = pb_model.exact_preds(x)
+  sqrt_weights = np.sqrt(pb_model.weights(x))
+  weighted_residuals = sqrt_weights * (y - fitted)
+  rng = np.random.default_rng(job['seed'])
+  replicate_params = np.full((job['num_replicates'], num_params), np.nan)
+  replicate_preds = np.full((job['num_replicates'], job['xvalues'].shape[0]), np.nan)
+  for replicate in range(job['num_replicates']):
+    if job['resample_type'] == 'cases':
+      sample = np.sort(rng.integers(0, x.shape[0], x.shape[0]))
+      sample_x, sample_y = x[sample], y[sample]
+    else:
+      sample_x = x
+      sample_y = fitted + weighted_residuals[rng.integers(0, x.shape[0], x.shape[0])] / sqrt_weights
+    refit = pb_model.polish_fit(base_params, sample_x, sample_y)
+    if not refit.success:
+      continue
+    replicate_params[replicate] = refit.x
+    pb_model.params[0:num_params] = refit.x
+    replicate_preds[replicate] = pb_model.exact_preds(job['xvalues'])
+  return replicate_params, replicate_preds
+
+
+#Runs the bootstrap for a fitted model and returns a dictionary with the replicate parameters, percentile
+#confidence intervals for each parameter and for predicted free drug at xvalues (the model's prediction
+#curve by default), and how many refits failed. The results are also kept on the model as bootstrap_results.
+def bootstrap_fit(pb_model, num_replicates = 2000, seed = 0, num_workers = None, resample_type = 'cases',
+                  confidence = 0.95, xvalues = None):
+  if pb_model.x_values_spanning_range is None:
+    raise ValueError('The model must be fitted before it can be bootstrapped.')
+  if resample_type not in ('cases', 'residuals'):
+    raise ValueError('resample_type must be "cases" or "residuals".')
+  if xvalues is None:
+    xvalues = pb_model.x_values_spanning_range
+  param_names = pb_model.model_associated_params[pb_model.model_type]
+  base_params = np.asarray([pb_model.params[pb_model.param_ids[param]] for param in param_names])
+  x, y = pb_model.fit_data()
+  block_seeds = np.random.SeedSequence(seed).spawn((num_replicates + block_size - 1) // block_size)
+  jobs = []
+  for block, block_seed in enumerate(block_seeds):
+    jobs.append({'model_type':pb_model.model_type, 'weight_type':pb_model.weight_type,
+                 'root_engine':pb_model.root_engine, 'x':x, 'y':y, 'base_params':base_params,
+                 'xvalues':np.asarray(xvalues, dtype=np.float64), 'resample_type':resample_type,
+                 'seed':block_seed, 'num_replicates':min(block_size, num_replicates - block * block_size)})
+  if num_workers == 1 or len(jobs) == 1:
+    blocks = [bootstrap_block(job) for job in jobs]
+  else:
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+      blocks = list(executor.map(bootstrap_block, jobs))
+  replicate_params = np.concatenate([block[0] for block in blocks])
+  replicate_preds = np.concatenate([block[1] for block in blocks])
+  #The sites are interchangeable, so put each replicate's sites in the same order as the base fit before
+  #taking percentiles or a swapped refit would look like a huge excursion.
+  if pb_model.model_type > 0:
+    replicate_params = match_site_order(replicate_params, base_params)
+  tail = 100 * (1 - confidence) / 2
+  failed = np.isnan(replicate_params[:, 0])
+  results = {'replicate_params':replicate_params, 'replicate_preds':replicate_preds, 'xvalues':xvalues,
+             'num_replicates':num_replicates, 'num_failed':int(np.sum(failed)), 'confidence':confidence,
+             'resample_type':resample_type, 'seed':seed}
+  results['param_ci'] = {param:(np.nanpercentile(replicate_params[:, j], tail),
+                                np.nanpercentile(replicate_params[:, j], 100 - tail))
+                         for j, param in enumerate(param_names)}
+  results['param_median'] = {param:np.nanmedian(replicate_params[:, j]) for j, param in enumerate(param_names)}
+  results['predicted_free_ci'] = (np.nanpercentile(replicate_preds, tail, axis=0),
+                                  np.nanpercentile(replicate_preds, 100 - tail, axis=0))
+  pb_model.bootstrap_results = results
+  return results
+
+
+#Reorders the sites of each row of param_matrix to whichever permutation is closest (in log space) to the
+#base parameters.
+def match_site_order(param_matrix, base_params):
+  num_sites = base_params.shape[0] // 2
+  sites = param_matrix.reshape(param_matrix.shape[0], num_sites, 2)
+  base_sites = np.log(base_params.reshape(num_sites, 2))
+  best_sites, best_distance = sites, None
+  for order in itertools.permutations(range(num_sites)):
+    candidate = sites[:, list(order), :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      distance = np.sum((np.log(candidate) - base_sites)**2, axis=(1, 2))
+    if best_distance is None:
+      best_sites, best_distance = candidate, distance
+    else:
+      closer = distance < best_distance
+      best_sites = np.where(closer[:, np.newaxis, np.newaxis], candidate, best_sites)
+      best_distance = np.where(closer, distance, best_distance)
+  return best_sites.reshape(param_matrix.shape)
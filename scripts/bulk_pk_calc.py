@@ -0,0 +1,212 @@
+import numpy as np, pandas as pd, model_building, model_io, argparse, os, time
+
+#Free drug for a bank of saved models (e.g. one per drug and species) applied to many PK files (e.g. one per
+#subject) in one go. The concentrations of all the PK files are taken together in chunks of chunk_size, and
+#the models are grouped by model type so that each group is evaluated with one call to batch_preds per chunk,
+#i.e. a single vectorized onebind / root solver pass over (models in the group x concentrations) instead of a
+#make_preds call per model and file. The exact solver is used for every model, lookup tables are ignored.
+#
+#The output is one long table with a row per model and concentration - model, subject, row (the row of the
+#concentration in its PK file), total and free concentration, and the full paths of the model and PK files
+#(blank for models and concentrations passed in memory) - written chunk by chunk, so memory use depends
+#on the chunk size and the number of models rather than the size of the output. The format follows the
+#output file's extension: .parquet (one row group per chunk and model group), .feather or .arrow (Arrow IPC,
+#readable with pandas.read_feather) or .csv. Parquet and Feather need pyarrow.
+#
+#Models and subjects are labelled by file name, with as many of the enclosing folders as it takes to tell
+#files of the same name apart (rat/drug_a and dog/drug_a); labels that still clash are an error rather than
+#rows that can't be told apart.
+
+output_columns = ['model', 'subject', 'row', 'total_concentration', 'free_concentration', 'model_source',
+                  'subject_source']
+output_formats = {'.parquet':'parquet', '.feather':'feather', '.arrow':'feather', '.csv':'csv'}
+
+
+def load_model(source):
+  if isinstance(source, model_building.protbind_model):
+    return source
+  return model_io.load_model(source)
+
+
+#Total concentrations from the first column of a PK file (no header, any other columns ignored).
+def load_pk_file(source):
+  return pd.read_csv(source, header=None, usecols=[0]).values[:,0].astype(float)
+
+
+def source_path(source):
+  return os.path.normpath(os.path.abspath(source)) if isinstance(source, str) else ''
+
+
+#Labels for a list of files (or in-memory sources, which become prefix_1, prefix_2, ...): the file name without
+#its extension, extended by the enclosing folders only as far as needed to make every label unique.
+def source_labels(sources, prefix):
+  parts = []
+  for source in sources:
+    if isinstance(source, str):
+      path_parts = source_path(source).split(os.sep)
+      path_parts[-1] = os.path.splitext(path_parts[-1])[0]
+      parts.append([part for part in path_parts if part])
+    else:
+      parts.append(None)
+  depths = [1] * len(sources)
+  while True:
+    labels = ['/'.join(parts[index][-depths[index]:]) if parts[index] is not None else '%s_%s'%(prefix, index + 1)
+              for index in range(len(sources))]
+    clashes = {}
+    for index, label in enumerate(labels):
+      clashes.setdefault(label, []).append(index)
+    clashes = [indices for indices in clashes.values() if len(indices) > 1]
+    if not clashes:
+      return labels
+    for indices in clashes:
+      deeper = [index for index in indices if parts[index] is not None and depths[index] < len(parts[index])]
+      if not deeper:
+        raise ValueError('More than one %s would be labelled %s; is the same file given twice?'%
+                         (prefix, labels[indices[0]]))
+      for index in deeper:
+        depths[index] += 1
+
+
+def check_labels(labels, kind):
+  seen = set()
+  duplicates = sorted(set(str(label) for label in labels if label in seen or seen.add(label)))
+  if duplicates:
+    raise ValueError('Duplicate %s labels: %s'%(kind, ', '.join(duplicates)))
+
+
+#Splits the models into groups of the same model type. Returns a list of (model indices, parameter matrix)
+#with one row per model in model_associated_params order, ready for batch_preds.
+def group_models(models):
+  groups = {}
+  for index, pb_model in enumerate(models):
+    if pb_model.x_values_spanning_range is None:
+      raise ValueError('Model %s must be fitted or loaded before running PK calculations.'%(index + 1))
+    groups.setdefault(pb_model.model_type, []).append(index)
+  model_groups = []
+  for model_type, indices in sorted(groups.items()):
+    num_params = len(models[indices[0]].model_associated_params[model_type])
+    model_groups.append((indices, np.asarray([models[index].params[0:num_params] for index in indices])))
+  return model_groups
+
+
+#Free drug for every model at every concentration in x, as an array with one row per model.
+def batch_free_drug(models, x, model_groups = None):
+  if model_groups is None:
+    model_groups = group_models(models)
+  x = np.asarray(x, dtype=np.float64)
+  free_concentrations = np.zeros((len(models), x.shape[0]))
+  for indices, param_matrix in model_groups:
+    free_concentrations[indices], _, _ = models[indices[0]].batch_preds(param_matrix, x)
+  return free_concentrations
+
+
+#Writes the long table a piece at a time in whichever format the output file's extension asks for.
+class long_table_writer:
+  def __init__(self, output_file):
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in output_formats:
+      raise ValueError('Unknown output format %s; use one of %s.'%(extension, ', '.join(sorted(output_formats))))
+    self.output_format = output_formats[extension]
+    self.output_file = output_file
+    self.writer = None
+    self.handle = None
+    if self.output_format != 'csv':
+      try:
+        import pyarrow
+      except ImportError as err:
+        raise ImportError('Writing %s files needs pyarrow (pip install pyarrow); '
+                          'use a .csv output instead.'%self.output_format) from err
+
+  def write(self, table):
+    if self.output_format == 'csv':
+      if self.handle is None:
+        self.handle = open(self.output_file, 'w', newline='')
+        table.to_csv(self.handle, index=False)
+      else:
+        table.to_csv(self.handle, index=False, header=False)
+      return
+    import pyarrow
+    arrow_table = pyarrow.Table.from_pandas(table, preserve_index=False)
+    if self.writer is None:
+      if self.output_format == 'parquet':
+        import pyarrow.parquet
+        self.writer = pyarrow.parquet.ParquetWriter(self.output_file, arrow_table.schema)
+      else:
+        import pyarrow.ipc
+        self.writer = pyarrow.ipc.new_file(self.output_file, arrow_table.schema)
+    self.writer.write_table(arrow_table)
+
+  def close(self):
+    if self.handle is not None:
+      self.handle.close()
+    if self.writer is not None:
+      self.writer.close()
+
+
+#Scores every model against every PK file and writes the long table to output_file (see above). models and
+#pk_files may be file names or already loaded models / arrays of total concentrations; the labels default to
+#the file names (see source_labels) and must be unique. progress_callback, if given, is called with the number
+#of concentrations done after each chunk. Returns some statistics on the run, like stream_pk_calculations.
+def bulk_pk_calculations(models, pk_files, output_file, chunk_size = 100000, model_labels = None,
+                         subject_labels = None, progress_callback = None):
+  start_time = time.time()
+  if model_labels is None:
+    model_labels = source_labels(models, 'model')
+  if subject_labels is None:
+    subject_labels = source_labels(pk_files, 'subject')
+  check_labels(model_labels, 'model')
+  check_labels(subject_labels, 'subject')
+  model_sources = pd.Categorical([source_path(source) for source in models])
+  subject_sources = pd.Categorical([source_path(source) for source in pk_files])
+  models = [load_model(source) for source in models]
+  model_groups = group_models(models)
+  concentrations = [load_pk_file(source) if isinstance(source, str) else np.asarray(source, dtype=np.float64)
+                    for source in pk_files]
+  x = np.concatenate(concentrations)
+  subjects = np.repeat(np.arange(len(concentrations)), [values.shape[0] for values in concentrations])
+  rows = np.concatenate([np.arange(values.shape[0]) for values in concentrations])
+  model_labels = pd.Categorical(model_labels)
+  subject_labels = pd.Categorical(subject_labels)
+  stats = {'models':len(models), 'subjects':len(concentrations), 'model_groups':len(model_groups),
+           'concentrations':x.shape[0], 'rows':0, 'chunks':0}
+  writer = long_table_writer(output_file)
+  try:
+    for chunk_start in range(0, x.shape[0], chunk_size):
+      chunk = slice(chunk_start, chunk_start + chunk_size)
+      chunk_x = x[chunk]
+      free_concentrations = batch_free_drug(models, chunk_x, model_groups)
+      for indices, _ in model_groups:
+        num_rows = len(indices) * chunk_x.shape[0]
+        table = pd.DataFrame({'model':model_labels[np.repeat(indices, chunk_x.shape[0])],
+                              'subject':subject_labels[np.tile(subjects[chunk], len(indices))],
+                              'row':np.tile(rows[chunk], len(indices)),
+                              'total_concentration':np.tile(chunk_x, len(indices)),
+                              'free_concentration':free_concentrations[indices].ravel(),
+                              'model_source':model_sources[np.repeat(indices, chunk_x.shape[0])],
+                              'subject_source':subject_sources[np.tile(subjects[chunk], len(indices))]},
+                             columns=output_columns)
+        writer.write(table)
+        stats['rows'] += num_rows
+      stats['chunks'] += 1
+      if progress_callback is not None:
+        progress_callback(min(chunk_start + chunk_size, x.shape[0]))
+  finally:
+    writer.close()
+  stats['seconds'] = time.time() - start_time
+  stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+  return stats
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Calculate free drug for many PK files with many saved models.')
+  parser.add_argument('output', help='Where to write the long table (.parquet, .feather, .arrow or .csv)')
+  parser.add_argument('--models', nargs='+', required=True, help='Models saved from the GUI')
+  parser.add_argument('--pk-files', nargs='+', required=True,
+                      help='csv files with total concentrations in the first column and no header')
+  parser.add_argument('--chunk-size', type=int, default=100000,
+                      help='Concentrations to calculate at a time (for every model)')
+  args = parser.parse_args()
+  stats = bulk_pk_calculations(args.models, args.pk_files, args.output, args.chunk_size)
+  print('Calculated free drug for %s models x %s concentrations (%s rows, %s model groups) in %.1f s (%.0f rows/s)'%
+        (stats['models'], stats['concentrations'], stats['rows'], stats['model_groups'], stats['seconds'],
+         stats['rows_per_second']))
@@ -0,0 +1,163 @@
+import numpy as np, hashlib, json, os, collections
+
+#A cache of fit results so that refitting a dataset we have already fitted with the same settings (clicking
+#Fit/Plot again in the GUI, or the same file turning up twice in a batch) is instant. Entries are keyed on a
+#hash of the numeric data together with every setting that changes the answer, so a changed dataset or
+#setting simply misses the cache and nothing needs to be invalidated by hand in normal use. Entries are kept
+#in memory with least recently used eviction and, if a cache directory is given, also written there as
+#small .npz files (one per entry) which are evicted oldest first once the directory grows past
+#max_disk_bytes. The directory can be shared between processes, e.g. the workers of a batch fit.
+#
+#To use it, set a model's fit_cache attribute; model_fit then checks the cache before fitting and stores
+#successful fits in it:
+#
+#   current_model.fit_cache = fit_cache.fit_cache(cache_dir = 'fit_cache')
+
+cache_version = 1
+key_attributes = ['model_type', 'weight_type', 'error_type', 'root_engine', 'gradient_type', 'hessian_type',
+                  'search_type', 'optimizer_backend', 'multistart_settings']
+result_arrays = ['params', 'param_errors', 'covariance', 'x_values_spanning_range', 'predicted_free']
+result_values = ['AIC', 'fit_warning', 'optimizer_stats']
+
+
+class fit_cache:
+  def __init__(self, max_entries = 256, cache_dir = None, max_disk_bytes = 100 * 1024**2):
+    self.max_entries = max_entries
+    self.cache_dir = cache_dir
+    self.max_disk_bytes = max_disk_bytes
+    self.entries = collections.OrderedDict()
+    self.stats = {'memory_hits':0, 'disk_hits':0, 'misses':0, 'stores':0, 'evictions':0, 'disk_evictions':0}
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+
+  #The key for fitting (x, y) with the model's current settings.
+  def key(self, pb_model, x, y):
+    settings = {attribute:getattr(pb_model, attribute) for attribute in key_attributes}
+    settings['cache_version'] = cache_version
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for values in (x, y):
+      values = np.ascontiguousarray(values, dtype=np.float64)
+      digest.update(str(values.shape).encode())
+      digest.update(values.tobytes())
+    return digest.hexdigest()
+
+  #Copies the cached result for key into the model and returns True, or returns False on a miss.
+  def restore(self, key, pb_model):
+    result = self.lookup(key)
+    if result is None:
+      return False
+    for attribute in result_arrays:
+      setattr(pb_model, attribute, np.copy(result[attribute]))
+    for attribute in result_values:
+      value = result[attribute]
+      setattr(pb_model, attribute, dict(value) if isinstance(value, dict) else value)
+    return True
+
+  #Stores the model's current (successful) fit under key.
+  def save(self, key, pb_model):
+    result = {attribute:np.array(getattr(pb_model, attribute), dtype=np.float64) for attribute in result_arrays}
+    for attribute in result_values:
+      value = getattr(pb_model, attribute)
+      result[attribute] = dict(value) if isinstance(value, dict) else value
+    self.store(key, result)
+
+  def lookup(self, key):
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      self.stats['memory_hits'] += 1
+      return self.entries[key]
+    result = self.read_entry(key)
+    if result is None:
+      self.stats['misses'] += 1
+      return None
+    self.stats['disk_hits'] += 1
+    self.remember(key, result)
+    return result
+
+  def store(self, key, result):
+    self.stats['stores'] += 1
+    self.remember(key, result)
+    if self.cache_dir is not None:
+      self.write_entry(key, result)
+
+  def remember(self, key, result):
+    self.entries[key] = result
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+      self.stats['evictions'] += 1
+
+  #Removes one entry, given either its key or a model whose current dataset (less any excluded points) and
+  #settings identify it.
+  def invalidate(self, key = None, pb_model = None):
+    if key is None:
+      x, y = pb_model.fit_data()
+      key = self.key(pb_model, x, y)
+    self.entries.pop(key, None)
+    if self.cache_dir is not None and os.path.exists(self.entry_path(key)):
+      os.remove(self.entry_path(key))
+
+  #Empties the cache, including the cache directory unless disk is False.
+  def clear(self, disk = True):
+    self.entries.clear()
+    if disk and self.cache_dir is not None:
+      for filename in self.disk_entries():
+        os.remove(filename)
+
+  def summary(self):
+    summary = dict(self.stats)
+    hits = summary['memory_hits'] + summary['disk_hits']
+    summary['hits'] = hits
+    summary['hit_rate'] = hits / (hits + summary['misses']) if hits + summary['misses'] > 0 else 0.0
+    summary['entries'] = len(self.entries)
+    return summary
+
+  def entry_path(self, key):
+    return os.path.join(self.cache_dir, '%s.npz'%key)
+
+  def disk_entries(self):
+    return [os.path.join(self.cache_dir, filename) for filename in os.listdir(self.cache_dir)
+            if filename.endswith('.npz')]
+
+  def read_entry(self, key):
+    if self.cache_dir is None or not os.path.exists(self.entry_path(key)):
+      return None
+    try:
+      with np.load(self.entry_path(key), allow_pickle=False) as entry:
+        result = json.loads(str(entry['header']))
+        for attribute in result_arrays:
+          result[attribute] = entry[attribute]
+      #Touching the file marks it as recently used for the disk eviction.
+      os.utime(self.entry_path(key))
+    except (OSError, ValueError, KeyError):
+      #Another process may have evicted or be replacing the entry; treat it as a miss.
+      return None
+    return result
+
+  #Entries are written to a temporary file and renamed so other processes never see half a file.
+  def write_entry(self, key, result):
+    header = {attribute:result[attribute] for attribute in result_values}
+    temporary_path = '%s.%s.tmp'%(self.entry_path(key), os.getpid())
+    with open(temporary_path, 'wb') as entry:
+      np.savez(entry, header=np.array(json.dumps(header, default=lambda value: value.item())),
+               **{attribute:result[attribute] for attribute in result_arrays})
+    os.replace(temporary_path, self.entry_path(key))
+    self.evict_disk_entries()
+
+  def evict_disk_entries(self):
+    sizes = {}
+    for filename in self.disk_entries():
+      try:
+        sizes[filename] = (os.path.getmtime(filename), os.path.getsize(filename))
+      except OSError:
+        continue
+    total = sum(size for _, size in sizes.values())
+    for filename in sorted(sizes, key=lambda filename: sizes[filename][0]):
+      if total <= self.max_disk_bytes:
+        break
+      try:
+        os.remove(filename)
+      except OSError:
+        continue
+      total -= sizes[filename][1]
+      self.stats['disk_evictions'] += 1
@@ -0,0 +1,68 @@
+import time
+from contextlib import contextmanager
+
+#Lightweight instrumentation for the fitting pipeline. When a protbind_model has instrumentation switched
+#on, every call to model_fit gets a fresh fit_stats object (the model's fit_stats attribute) which counts
+#residual evaluations, root solver calls and rows solved, records the optimizer iterations used from each
+#starting point and times the main stages of the fit. When instrumentation is off fit_stats is None and the
+#only cost in the hot paths is checking for that.
+#
+#Callbacks are called as callback(event, name, value) where event is 'count', 'timer' or 'start' - e.g.
+#('timer', 'search', 0.12) when the multistart search finishes or ('start', 'iterations', 14) after each
+#optimizer run - so a GUI or batch job can follow a fit as it happens.
+
+class fit_stats:
+  def __init__(self, callbacks = None):
+    self.counters = {}
+    self.timers = {}
+    self.start_iterations = []
+    self.start_function_evaluations = []
+    self.callbacks = [] if callbacks is None else list(callbacks)
+
+  def count(self, name, amount = 1):
+    self.counters[name] = self.counters.get(name, 0) + amount
+    for callback in self.callbacks:
+      callback('count', name, amount)
+
+  def add_time(self, name, seconds):
+    self.timers[name] = self.timers.get(name, 0.0) + seconds
+    for callback in self.callbacks:
+      callback('timer', name, seconds)
+
+  @contextmanager
+  def timer(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_time(name, time.perf_counter() - start)
+
+  #Records the result of one optimizer run from one starting point.
+  def record_start(self, iterations, function_evaluations):
+    self.start_iterations.append(int(iterations))
+    self.start_function_evaluations.append(int(function_evaluations))
+    for callback in self.callbacks:
+      callback('start', 'iterations', iterations)
+
+  #Everything as a flat dictionary, handy for logging or adding to a results table.
+  def summary(self):
+    summary = dict(self.counters)
+    for name, seconds in self.timers.items():
+      summary['%s_seconds'%name] = seconds
+    summary['optimizer_starts'] = len(self.start_iterations)
+    summary['optimizer_iterations'] = sum(self.start_iterations)
+    summary['optimizer_function_evaluations'] = sum(self.start_function_evaluations)
+    return summary
+
+  #A human readable breakdown of where the time went.
+  def report(self):
+    lines = ['Timing breakdown:']
+    total = sum(self.timers.values())
+    for name, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+      lines.append('  %-20s %9.1f ms  (%4.1f%%)'%(name, 1000 * seconds, 100 * seconds / total if total > 0 else 0))
+    lines.append('Counts:')
+    for name, value in sorted(self.counters.items()):
+      lines.append('  %-20s %9d'%(name, value))
+    lines.append('  %-20s %9d'%('optimizer_starts', len(self.start_iterations)))
+    lines.append('  %-20s %9d'%('optimizer_iterations', sum(self.start_iterations)))
+    return '\n'.join(lines)
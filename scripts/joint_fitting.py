@@ -0,0 +1,212 @@
+import numpy as np, pandas as pd, model_building, argparse, contextlib, io, os
+from scipy.optimize import minimize
+
+#Joint fitting of several protein binding datasets for the same drug (e.g. different plasma lots or species)
+#where some parameters are shared by every dataset and the rest are fitted separately for each, e.g. a
+#common kd1 with a p1 per lot. The parameter vector is the shared parameters followed by one block of local
+#parameters per dataset, and the objective is the sum of the datasets' weighted sums of squares. Every
+#evaluation just runs each dataset's own residual and gradient once, so its cost grows linearly with the
+#number of datasets, and L-BFGS-B never forms a dense matrix over all the parameters.
+#
+#Each dataset is first fitted on its own (with the usual multistart search) and the joint fit starts from
+#those estimates, with each shared parameter starting at the geometric mean of the separate estimates. The
+#Hessian of the joint objective has an arrow shape: a shared block, a shared-local strip per dataset and a
+#block diagonal of local blocks. So the covariance is found from the Schur complement of the local blocks,
+#which again costs time linear in the number of datasets instead of inverting the whole matrix. Errors
+#and the AIC are calculated just as calc_error does for a single fit, using every point in every dataset.
+
+model_objectives = {0:'onebind_resid_grad', 1:'twobind_resid_grad', 2:'threebind_resid_grad'}
+
+
+def load_dataset(source):
+  if isinstance(source, pd.DataFrame):
+    return source
+  data = pd.read_csv(source, header=None)
+  data.columns = ['total', 'free']
+  return data
+
+
+#Fits the datasets jointly. datasets is a list of DataFrames (with total and free columns) or csv files,
+#shared lists the names of the parameters common to all of them and labels optionally names the datasets.
+#Returns a dictionary with the shared and per-dataset parameters and their errors, the joint AIC, the sum of
+#the AICs of the separate fits for comparison (nan if any of them failed), a status ('0' if all went well,
+#otherwise an error message in the style of model_fit covering every separate fit that failed, a joint fit
+#that didn't converge and a Hessian that couldn't be inverted) and a fitted protbind_model per dataset
+#holding its joint parameters, their errors and the joint AIC, which can be plotted, saved or used for PK
+#calculations like any other model. If the data can't be read as numbers nothing is fitted and only the
+#status is filled in.
+def joint_fit(datasets, model_type = 1, weight_type = 0, shared = ('kd1',), labels = None):
+  if labels is None:
+    labels = ['dataset_%s'%(i+1) for i in range(len(datasets))]
+  models = [model_building.protbind_model(model_type = model_type, weight_type = weight_type)
+            for dataset in datasets]
+  associated_params = models[0].model_associated_params[model_type]
+  for param in shared:
+    if param not in associated_params:
+      raise ValueError('%s is not a parameter of model type %s.'%(param, model_type))
+  shared_index = [associated_params.index(param) for param in associated_params if param in shared]
+  local_index = [associated_params.index(param) for param in associated_params if param not in shared]
+  num_datasets, num_params = len(datasets), len(associated_params)
+  num_shared, num_local = len(shared_index), len(local_index)
+
+  try:
+    datasets = [load_dataset(dataset) for dataset in datasets]
+    xs = [np.asarray(dataset['total'].values, dtype=np.float64) for dataset in datasets]
+    ys = [np.asarray(dataset['free'].values, dtype=np.float64) for dataset in datasets]
+  except (KeyError, TypeError, ValueError):
+    return {'shared':{}, 'datasets':[], 'models':models, 'optimizer_success':False, 'AIC':np.nan,
+            'separate_AIC':np.nan, 'weighted_sum_of_squares':np.nan, 'num_points':0, 'num_fitted_params':0,
+            'status':('could not convert data to numeric form! Are you sure your '
+                      'input protein binding datasets are only non-numeric characters?')}
+
+  errors = []
+  separate_params = np.zeros((num_datasets, num_params))
+  separate_success = np.zeros(num_datasets, dtype=bool)
+  separate_AIC = 0.0
+  for i, (pb_model, dataset) in enumerate(zip(models, datasets)):
+    pb_model.associated_data = dataset
+    with contextlib.redirect_stdout(io.StringIO()):
+      error_code = pb_model.model_fit()
+    separate_params[i] = pb_model.params[0:num_params]
+    separate_success[i] = error_code == '0'
+    separate_AIC += pb_model.AIC
+    if error_code != '0':
+      errors.append('The separate fit of %s failed: %s'%(labels[i], error_code))
+  if not np.all(separate_success):
+    separate_AIC = np.nan
+  objectives = [getattr(pb_model, model_objectives[model_type]) for pb_model in models]
+
+  def expand(theta):
+    full = np.zeros((num_datasets, num_params))
+    full[:, shared_index] = theta[0:num_shared]
+    full[:, local_index] = theta[num_shared:].reshape(num_datasets, num_local)
+    return full
+
+  #The joint fit works with the logs of the parameters, which keeps it well scaled (and the parameters
+  #positive) however many datasets there are.
+  def joint_objective(log_theta):
+    theta = np.exp(log_theta)
+    full = expand(theta)
+    total = 0.0
+    gradients = np.zeros((num_datasets, num_params))
+    for i in range(num_datasets):
+      value, gradients[i] = objectives[i](full[i], xs[i], ys[i])
+      total += value
+    gradient = np.concatenate((np.sum(gradients[:, shared_index], axis=0), gradients[:, local_index].ravel()))
+    return total, gradient * theta
+
+  #The shared parameters start from the separate fits that worked, if there are any.
+  log_separate = np.log(np.maximum(separate_params, 1e-10))
+  starting_fits = separate_success if np.any(separate_success) else np.ones(num_datasets, dtype=bool)
+  initial = np.concatenate((np.mean(log_separate[np.ix_(starting_fits, shared_index)], axis=0),
+                            log_separate[:, local_index].ravel()))
+  joint = minimize(joint_objective, x0=initial, method='L-BFGS-B', jac=True)
+  if not joint.success:
+    errors.append('The joint fit did not converge (%s).'%joint.message)
+  full = expand(np.exp(joint.x))
+  net_residuals = joint.fun
+  num_points = sum(x.shape[0] for x in xs)
+  num_fitted = initial.shape[0]
+
+  shared_cov, local_covs = joint_covariance(models, full, xs, ys, shared_index, local_index)
+  if shared_cov is None:
+    errors.append('There was an error inverting the Hessian; the problem is likely ill-posed.'
+                  'Try sharing more parameters or using a less flexible model.')
+  status = ' '.join(errors) if errors else '0'
+  variance_scale = net_residuals / (num_points - num_fitted)
+
+  result = {'shared':{}, 'datasets':[], 'models':models, 'status':status, 'optimizer_success':bool(joint.success),
+            'AIC':net_residuals + 2*num_fitted + 2*num_fitted*(num_fitted+1)/(num_points-num_fitted-1),
+            'separate_AIC':separate_AIC, 'weighted_sum_of_squares':net_residuals, 'num_points':num_points,
+            'num_fitted_params':num_fitted}
+  for j, index in enumerate(shared_index):
+    error = np.sqrt(variance_scale * shared_cov[j, j]) if shared_cov is not None else np.nan
+    result['shared'][associated_params[index]] = (full[0, index], error)
+  for i, pb_model in enumerate(models):
+    pb_model.params = np.zeros(pb_model.params.shape)
+    pb_model.params[0:num_params] = full[i]
+    pb_model.param_errors = np.full(pb_model.param_errors.shape, np.nan)
+    for j, index in enumerate(shared_index):
+      pb_model.param_errors[index] = result['shared'][associated_params[index]][1]
+    if local_covs is not None:
+      for j, index in enumerate(local_index):
+        pb_model.param_errors[index] = np.sqrt(variance_scale * local_covs[i][j, j])
+    pb_model.covariance = None
+    pb_model.AIC = result['AIC']
+    pb_model.clear_lookup_table()
+    pb_model.predicted_free, _ = pb_model.make_preds(pb_model.x_values_spanning_range)
+    result['datasets'].append({'label':labels[i], 'num_points':xs[i].shape[0],
+                               'params':{param:pb_model.params[pb_model.param_ids[param]]
+                                         for param in associated_params},
+                               'errors':{param:pb_model.param_errors[pb_model.param_ids[param]]
+                                         for param in associated_params}})
+  return result
+
+
+#Covariance of the shared parameters and of each dataset's local parameters (before scaling by the
+#residual variance) from the block structured Hessian. With A the shared block, B_i the shared-local strip
+#and D_i the local block of dataset i, the shared covariance is the inverse of the Schur complement
+#S = A - sum_i B_i D_i^-1 B_i^T and dataset i's local covariance is D_i^-1 + D_i^-1 B_i^T S^-1 B_i D_i^-1.
+#Returns (None, None) if the Hessian can't be inverted or gives a negative variance.
+def joint_covariance(models, full, xs, ys, shared_index, local_index):
+  num_shared = len(shared_index)
+  shared_block = np.zeros((num_shared, num_shared))
+  strips, local_inverses = [], []
+  try:
+    for i, pb_model in enumerate(models):
+      pb_model.params[0:full.shape[1]] = full[i]
+      hessian = pb_model.analytic_hessian(xs[i], ys[i])
+      shared_block += hessian[np.ix_(shared_index, shared_index)]
+      strips.append(hessian[np.ix_(shared_index, local_index)])
+      local_inverses.append(np.linalg.inv(hessian[np.ix_(local_index, local_index)]) if local_index
+                            else np.zeros((0, 0)))
+    schur = shared_block - sum(np.dot(np.dot(strip, local_inverse), strip.T)
+                               for strip, local_inverse in zip(strips, local_inverses))
+    shared_cov = np.linalg.inv(schur) if num_shared > 0 else np.zeros((0, 0))
+  except np.linalg.LinAlgError:
+    return None, None
+  local_covs = []
+  for strip, local_inverse in zip(strips, local_inverses):
+    coupling = np.dot(local_inverse, strip.T)
+    local_covs.append(local_inverse + np.dot(np.dot(coupling, shared_cov), coupling.T))
+  if np.min(np.diag(shared_cov), initial=0) < 0 or \
+     any(np.min(np.diag(local_cov), initial=0) < 0 for local_cov in local_covs):
+    return None, None
+  return shared_cov, local_covs
+
+
+#One row per dataset with every parameter, its error and whether it was shared.
+def joint_results_table(result):
+  rows = []
+  for dataset in result['datasets']:
+    row = {'dataset':dataset['label'], 'num_points':dataset['num_points']}
+    for param, value in dataset['params'].items():
+      row[param] = value
+      row['%s_error'%param] = dataset['errors'][param]
+      row['%s_shared'%param] = param in result['shared']
+    row['joint_AIC'] = result['AIC']
+    row['separate_AIC'] = result['separate_AIC']
+    row['status'] = 'ok' if result['status'] == '0' else 'error: %s'%result['status']
+    rows.append(row)
+  return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fit several protein binding datasets jointly with shared parameters.')
+  parser.add_argument('datasets', nargs='+', help='Protein binding csv files (total, free; no header)')
+  parser.add_argument('--output', default=None, help='Where to write the results csv')
+  parser.add_argument('--model-type', type=int, default=1, choices=sorted(model_objectives),
+                      help='0 = single binding site, 1 = two binding site, 2 = three binding site')
+  parser.add_argument('--weight-type', type=int, default=0, choices=[0, 1, 2, 3],
+                      help='0 = none, 1 = 1/C, 2 = 1/C^2, 3 = 1/C^3')
+  parser.add_argument('--shared', nargs='*', default=['kd1'], help='Parameters shared by all datasets (default kd1)')
+  args = parser.parse_args()
+  labels = [os.path.splitext(os.path.basename(dataset))[0] for dataset in args.datasets]
+  result = joint_fit(args.datasets, args.model_type, args.weight_type, args.shared, labels)
+  table = joint_results_table(result)
+  print(table.to_string(index=False))
+  print('Joint AIC %.4g (separate fits %.4g)'%(result['AIC'], result['separate_AIC']))
+  if result['status'] != '0':
+    print(result['status'])
+  if args.output is not None:
+    table.to_csv(args.output, index=False)
@@ -1,67 +1,326 @@
-import numpy as np, scipy, pandas as pd, numdifftools
-from scipy import optimize
-from scipy.optimize import minimize
-from sklearn.model_selection import ParameterGrid
-import ctypes, os
+import numpy as np
+import ctypes, os, contextlib, itertools, warnings, rootfinding, instrumentation
 from numpy.ctypeslib import ndpointer
-from PyQt5.QtWidgets import QMessageBox
+
+#Only NumPy is imported up front so the model can be imported quickly (and without Qt, pandas or sklearn) in
+#worker processes and scripts that only use fitted models. SciPy's optimizer and quasi-random samplers are
+#imported by the functions that need them the first time they are used.
 
 #We need to load the dll / so and set up two specific C++ functions for use in this
 #program. We do this using ctypes. The C++ functions will take 4 arguments: pointer
 #to the input numpy array, dimensions of the input array and pointer to the output numpy array
 #which the C++ functions will assume is correctly sized. THe output numpy array will be modified
 #in place so nothing needs to be returned. Extremely important the numpy arrays are C-contiguous!
-lib = np.ctypeslib.load_library('rootfinder.so', os.path.join('lib'))
-rootfind2 = lib.single_pos_special_cubic
-rootfind2.restype = None
-rootfind2.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-                ctypes.c_int, ctypes.c_int,
-                ndpointer(ctypes.c_double, flags="C_CONTIGUOUS")]
-
-rootfind3 = lib.single_pos_special_quartic
-rootfind3.restype = None
-rootfind3.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
-                ctypes.c_int, ctypes.c_int,
-                ndpointer(ctypes.c_double, flags="C_CONTIGUOUS")]
+#If the shared library hasn't been built for this platform we can still run using the pure NumPy root
+#engine in rootfinding.py, so a missing library is not an error here. The library lives in lib/ next to the
+#scripts directory, wherever the program is run from.
+lib_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+try:
+        lib = np.ctypeslib.load_library('rootfinder.so', lib_dir)
+except OSError:
+        lib = None
+
+if lib is not None:
+        rootfind2 = lib.single_pos_special_cubic
+        rootfind2.restype = None
+        rootfind2.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
+                        ctypes.c_int, ctypes.c_int,
+                        ndpointer(ctypes.c_double, flags="C_CONTIGUOUS")]
+
+        rootfind3 = lib.single_pos_special_quartic
+        rootfind3.restype = None
+        rootfind3.argtypes = [ndpointer(ctypes.c_double, flags="C_CONTIGUOUS"),
+                        ctypes.c_int, ctypes.c_int,
+                        ndpointer(ctypes.c_double, flags="C_CONTIGUOUS")]
+        default_root_engine = 'eigen'
+        root_engines = ['eigen', 'numpy']
+else:
+        rootfind2, rootfind3 = None, None
+        default_root_engine = 'numpy'
+        root_engines = ['numpy']
+
+#Every combination of the values in param_grid (a dictionary of lists) as a list of dictionaries, in the
+#same order as sklearn's ParameterGrid which we used to use: keys sorted, last key varying fastest.
+def parameter_grid(param_grid):
+        keys = sorted(param_grid)
+        return [dict(zip(keys, values)) for values in itertools.product(*[param_grid[key] for key in keys])]
+
+#Raised inside a fit when the model's cancel_event is set; model_fit turns it into an error message.
+class fit_cancelled(Exception):
+        pass
 
 #This is a generic model which may belong to one of several types (single binding site, two binding site or three binding
 #site). If it is single or two binding site only some of the parameters in the parameter dictionary will be used.
 #Model type corresponds to 0 = single binding site, 1 = two binding site and 2 = three binding site.
 #Weight type corresponds to 0 = none, 1 = 1/C and 2 = 1/C**2.
+#Root engine selects how the two-site free drug cubic (three-site quartic) is solved: 'eigen' uses the C++
+#companion matrix rootfinder one row at a time, 'numpy' uses the vectorized Newton solver in rootfinding.py
+#(warm-started from the roots found on the previous call with the same concentrations) and needs no compiled
+#library. Asking for 'eigen' when the library isn't there (e.g. a model saved on another machine) gives a
+#warning and the NumPy engine.
+#Gradient type selects whether the optimizer gets exact gradients of the residual functions ('analytic')
+#or estimates them by finite differences ('numerical', the original behavior). The iteration and function
+#evaluation counts for the last fit are kept in optimizer_stats so the two can be compared.
+#Hessian type selects how calc_error gets the Hessian of the residual function: 'exact' builds it from the
+#first and second derivatives of the model, 'gauss-newton' uses only the first derivatives (2 J^T W J) and
+#'numerical' uses numdifftools (the original behavior, slow but handy as a cross-check).
+#Search type selects how the starting points are explored: 'grid' runs a full local fit from every point
+#of the starting grid, 'multistart' first improves all of them together with a few vectorized
+#Levenberg-Marquardt steps, merges starts that have fallen into the same basin, prunes the clearly worse
+#ones and only then polishes the survivors with a local fit (see multistart_search and multistart_settings).
+#The starting points come from start_points: the 3**n grid of start_grid for the one and two-site models and
+#a budget of Sobol points for the three-site model, where the grid would have 729 points.
+#Optimizer backend selects the local optimizer run from each start: 'l-bfgs-b' minimizes the weighted sum of
+#squares (the original behavior) while 'least-squares' hands scipy's least_squares (trust region reflective,
+#which keeps the parameters positive) the weighted residual vector and its Jacobian, so it can make use of the
+#least squares structure of the problem. optimizer_stats records which backend was used.
+#If instrumentation is switched on each fit records counts and timings in fit_stats (see instrumentation.py),
+#and any callbacks in instrumentation_callbacks are told about them as the fit runs.
+#If fit_cache is set (see fit_cache.py) model_fit reuses the cached result when the same data has already been
+#fitted with the same settings, and from_cache says whether the last fit came from the cache.
+#A fit can be followed and stopped from another thread (e.g. by the GUI): progress_callback, if set, is called
+#as progress_callback(stage, done, total) after each probe step / optimizer run, and setting cancel_event (a
+#threading.Event) stops the fit at the next optimizer iteration, in which case model_fit returns an error
+#message and the model is left without a usable fit.
+#Points can be left out of the fit without removing them from associated_data: excluded_points is a boolean
+#mask over its rows (None when every point is used) which is kept up to date by exclude_points and add_points
+#and reset whenever a new dataset is assigned. After editing the points, refit updates the fit cheaply by
+#starting from the current parameters (see refit and refit_tolerance).
 class protbind_model:
         def __init__(self, model_type = 0, weight_type = 0, error_type = 0):
-                self.current_dataset = pd.DataFrame()
+                self.current_dataset = None
                 self.param_ids = {'kd1':0, 'p1':1, 'kd2':2,
-                                  'p2':3}
-                self.params = np.zeros((4))
-                self.param_errors = np.zeros((4))
+                                  'p2':3, 'kd3':4, 'p3':5}
+                self.params = np.zeros((6))
+                self.param_errors = np.zeros((6))
                 self.model_type = model_type
                 self.model_associated_params = {0:['kd1', 'p1'],
-                                                1:['kd1', 'p1', 'kd2', 'p2']}
+                                                1:['kd1', 'p1', 'kd2', 'p2'],
+                                                2:['kd1', 'p1', 'kd2', 'p2', 'kd3', 'p3']}
                 self.weight_type = weight_type
                 self.error_type = error_type
+                self.data_loader = None
                 self.associated_data = None
+                self.excluded_points = None
+                self.refit_tolerance = 0.5
                 self.predicted_free = None
                 self.x_values_spanning_range = None
                 self.AIC = 0
                 self.plot_color = 'b'
                 self.plot_title = None
+                self.fit_warning = None
+                self.root_engine = default_root_engine
+                self.warm_start_roots = None
+                self.gradient_type = 'analytic'
+                self.optimizer_stats = {}
+                self.hessian_type = 'exact'
+                self.covariance = None
+                self.search_type = 'multistart'
+                self.optimizer_backend = 'l-bfgs-b'
+                self.multistart_settings = {'probe_iterations':10, 'prune_tolerance':1.0,
+                                            'max_survivors':10, 'dedupe_tolerance':0.05,
+                                            'start_type':'auto', 'start_budget':128}
+                self.lookup_table = None
+                self.use_lookup_table = True
+                self.instrumentation = False
+                self.instrumentation_callbacks = []
+                self.fit_stats = None
+                self.bootstrap_results = None
+                self.fit_cache = None
+                self.from_cache = False
+                self.progress_callback = None
+                self.cancel_event = None
+
+        #The warm start roots are only a cache for the root solver, so there is no point saving them. Training
+        #data that hasn't been loaded from a model file yet is loaded now since the loader can't be pickled.
+        def __getstate__(self):
+                state = self.__dict__.copy()
+                state['warm_start_roots'] = None
+                state['fit_stats'] = None
+                state['fit_cache'] = None
+                state['progress_callback'] = None
+                state['cancel_event'] = None
+                state['instrumentation_callbacks'] = []
+                state['_associated_data'] = self.associated_data
+                state['data_loader'] = None
+                return state
+
+        #Models pickled by older versions of the program may be missing attributes (or settings) added since,
+        #so we start from a freshly initialized model and overwrite whatever the saved model has. The parameter
+        #tables describe the program rather than the model, so the current ones are kept (older models know only
+        #two sites), and shorter parameter vectors are padded to the current length.
+        def __setstate__(self, state):
+                self.__init__()
+                state = dict(state)
+                state.pop('param_ids', None)
+                state.pop('model_associated_params', None)
+                for attribute in ('params', 'param_errors'):
+                        if attribute in state:
+                                values = np.zeros(getattr(self, attribute).shape)
+                                saved = np.asarray(state[attribute], dtype=np.float64)
+                                values[0:saved.shape[0]] = saved[0:values.shape[0]]
+                                state[attribute] = values
+                if 'associated_data' in state:
+                        state['_associated_data'] = state.pop('associated_data')
+                if 'multistart_settings' in state:
+                        self.multistart_settings.update(state.pop('multistart_settings'))
+                #The root engine goes through its setter, in case the model was saved where the library was built.
+                root_engine = state.pop('_root_engine', None)
+                root_engine = state.pop('root_engine', root_engine)
+                self.__dict__.update(state)
+                if root_engine is not None:
+                        self.root_engine = root_engine
+
+        #The dataset the model is (or will be) fitted to, as a DataFrame with 'total' and 'free' columns. Models
+        #loaded from a file by model_io don't read their training data until something asks for it, in which
+        #case data_loader is called once to fetch it.
+        @property
+        def associated_data(self):
+                if self._associated_data is None and self.data_loader is not None:
+                        data_loader, self.data_loader = self.data_loader, None
+                        self._associated_data = data_loader()
+                return self._associated_data
+
+        @associated_data.setter
+        def associated_data(self, value):
+                self._associated_data = value
+                self.data_loader = None
+                self.excluded_points = None
+
+        @property
+        def root_engine(self):
+                return self._root_engine
+
+        @root_engine.setter
+        def root_engine(self, value):
+                if value not in ('eigen', 'numpy'):
+                        raise ValueError("Unknown root engine %s; use 'eigen' or 'numpy'."%value)
+                if value not in root_engines:
+                        warnings.warn('The eigen root engine needs rootfinder.so, which was not found in %s; '
+                                      'using the numpy root engine instead.'%os.path.normpath(lib_dir), RuntimeWarning)
+                        value = 'numpy'
+                self._root_engine = value
+
+        #The total and free concentrations to fit: the points of associated_data that haven't been excluded.
+        def fit_data(self):
+                x = np.asarray([float(z) for z in self.associated_data['total'].values])
+                y = np.asarray([float(z) for z in self.associated_data['free'].values])
+                if self.excluded_points is not None:
+                        x, y = x[~self.excluded_points], y[~self.excluded_points]
+                return x, y
+
+        #Excludes (or with excluded False, includes again) the points at the given row positions of
+        #associated_data. The model isn't refitted until refit or model_fit is called.
+        def exclude_points(self, indices, excluded = True):
+                if self.excluded_points is None:
+                        self.excluded_points = np.zeros(self.associated_data.shape[0], dtype=bool)
+                self.excluded_points[np.asarray(indices, dtype=int)] = excluded
+                if not np.any(self.excluded_points):
+                        self.excluded_points = None
+
+        #Appends points (e.g. a new replicate) to associated_data, keeping the exclusions of the existing ones.
+        def add_points(self, total, free):
+                import pandas as pd
+                excluded_points = self.excluded_points
+                new_points = pd.DataFrame({'total':np.atleast_1d(np.asarray(total, dtype=np.float64)),
+                                           'free':np.atleast_1d(np.asarray(free, dtype=np.float64))})
+                self.associated_data = pd.concat([self.associated_data, new_points], ignore_index=True)
+                if excluded_points is not None:
+                        self.excluded_points = np.concatenate((excluded_points, np.zeros(new_points.shape[0], dtype=bool)))
 
 
-###This function enables a fitted model to make predictions on demand.
+###This function enables a fitted model to make predictions on demand. If a lookup table has been built
+###(see build_lookup_table) it is used for concentrations inside its range.
         def make_preds(self, xvalues):
-                if self.associated_data is not None and self.x_values_spanning_range is not None:
-                        if self.model_type == 0:
-                                return (self.onebind(xvalues, self.params[0:2])), '0'
-                        if self.model_type == 1:
-                                return (self.twobind(xvalues, self.params)), '0'
+                if self.x_values_spanning_range is not None:
+                        if self.lookup_table is not None and self.use_lookup_table:
+                                return self.lookup_preds(xvalues), '0'
+                        return self.exact_preds(xvalues), '0'
                 else:
                         return 0, 'err'
 
+        def exact_preds(self, xvalues):
+                if self.model_type == 0:
+                        return self.onebind(xvalues, self.params[0:2])
+                if self.model_type == 1:
+                        return self.twobind(xvalues, self.params)
+                if self.model_type == 2:
+                        return self.threebind(xvalues, self.params)
+
+        #Splits a parameter vector into lists of kd and p, one entry per binding site.
+        def site_params(self, params):
+                num_sites = len(self.model_associated_params[self.model_type]) // 2
+                kds = [params[self.param_ids['kd%s'%(site+1)]] for site in range(num_sites)]
+                ps = [params[self.param_ids['p%s'%(site+1)]] for site in range(num_sites)]
+                return kds, ps
+
+
+###These functions build and use a lookup table for fast predictions from a fitted model.
+        #Once a model is fitted it never changes, and PK concentrations usually fall in a known range, so rather
+        #than solving for free drug at every point we can tabulate log(free) against log(total) over that range
+        #and interpolate. We use a cubic Hermite interpolant on an evenly spaced grid with the exact slopes
+        #(dF/dx from implicit differentiation), which is smooth, keeps the curve monotone in practice and is
+        #fourth order accurate. The grid is doubled until the relative error, checked against the exact solver
+        #at several points inside every interval, is below max_relative_error (or max_points is reached). The
+        #table is saved with the model; the verified error is returned and kept in the table.
+        def build_lookup_table(self, min_total, max_total, max_relative_error = 1e-8, initial_points = 64,
+                               max_points = 2**17):
+                kds, ps = self.site_params(self.params)
+                num_points = initial_points
+                while True:
+                        log_total = np.linspace(np.log(min_total), np.log(max_total), num_points)
+                        free = self.exact_preds(np.exp(log_total))
+                        log_free = np.log(free)
+                        log_slopes = np.exp(log_total) / free * rootfinding.free_drug_slope(free, kds, ps)
+                        self.lookup_table = {'log_total':log_total, 'log_free':log_free, 'log_slopes':log_slopes,
+                                             'min_total':float(min_total), 'max_total':float(max_total)}
+                        check_points = (log_total[:-1, np.newaxis] + np.diff(log_total)[:, np.newaxis] *
+                                        np.array([0.25, 0.5, 0.75])).ravel()
+                        check_points = np.exp(check_points)
+                        exact = self.exact_preds(check_points)
+                        relative_error = np.max(np.abs(self.interpolate_lookup(check_points) - exact) / exact)
+                        if relative_error <= max_relative_error or num_points >= max_points:
+                                break
+                        num_points = 2 * num_points
+                self.lookup_table['max_relative_error'] = float(relative_error)
+                return relative_error
+
+        def clear_lookup_table(self):
+                self.lookup_table = None
+
+        #Evaluates the Hermite interpolant; xvalues must lie within the range of the table.
+        def interpolate_lookup(self, xvalues):
+                table = self.lookup_table
+                log_total = table['log_total']
+                spacing = log_total[1] - log_total[0]
+                position = (np.log(xvalues) - log_total[0]) / spacing
+                index = np.clip(position.astype(np.intp), 0, log_total.shape[0] - 2)
+                t = position - index
+                t2 = t * t
+                one_minus_t2 = (1 - t) * (1 - t)
+                log_free = ((1 + 2*t) * one_minus_t2 * table['log_free'][index] +
+                            t * one_minus_t2 * spacing * table['log_slopes'][index] +
+                            t2 * (3 - 2*t) * table['log_free'][index + 1] +
+                            t2 * (t - 1) * spacing * table['log_slopes'][index + 1])
+                return np.exp(log_free)
+
+        #Predictions using the lookup table inside its range and the exact solver outside it.
+        def lookup_preds(self, xvalues):
+                xvalues = np.asarray(xvalues, dtype=np.float64)
+                inside = (xvalues >= self.lookup_table['min_total']) & (xvalues <= self.lookup_table['max_total'])
+                if np.all(inside):
+                        return self.interpolate_lookup(xvalues)
+                predicted = np.zeros(xvalues.shape)
+                predicted[inside] = self.interpolate_lookup(xvalues[inside])
+                predicted[~inside] = self.exact_preds(xvalues[~inside])
+                return predicted
+
 
 ###These functions are for the single-site binding model
 
         def onebind_resid(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
                 residuals = (self.onebind(x, params) - actual)
                 if self.weight_type == 0:
                         return np.dot(residuals, residuals)
@@ -72,6 +331,16 @@ class protbind_model:
                 elif self.weight_type == 3:
                         return np.sum(residuals * residuals * 1/(x**3))
 
+        #Returns the weighted sum of squares together with its exact gradient for use with jac=True.
+        def onebind_resid_grad(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
+                        self.fit_stats.count('gradient_evaluations')
+                predicted = self.onebind(x, params)
+                weighted_residuals = self.weights(x) * (predicted - actual)
+                return (np.dot(weighted_residuals, predicted - actual),
+                        2 * np.dot(weighted_residuals, self.onebind_jac(x, params)))
+
         def onebind(self, x, params):
                 kd = params[0]
                 ptot = params[1]
@@ -79,10 +348,21 @@ class protbind_model:
                                                                 4*kd*x)
                 return predicted
 
+        #Derivatives of the predicted free drug with respect to kd and ptot (one column each). predicted is
+        #accepted only so this can be called the same way as twobind_jac and threebind_jac.
+        def onebind_jac(self, x, params, predicted = None):
+                kd = params[0]
+                ptot = params[1]
+                root = np.sqrt( (kd + ptot - x)**2 + 4*kd*x)
+                return np.column_stack((-0.5 + 0.5*(kd + ptot + x) / root,
+                                        -0.5 + 0.5*(kd + ptot - x) / root))
+
 
 ###These functions are for the two-site binding model
 
         def twobind_resid(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
                 residuals = (self.twobind(x, params) - actual)
                 if self.weight_type == 0:
                         return np.dot(residuals, residuals)
@@ -92,11 +372,25 @@ class protbind_model:
                         return np.sum(residuals * residuals * 1/(x**2))
                 elif self.weight_type == 3:
                         return np.sum(residuals * residuals * 1/(x**3))
+
+        def twobind_resid_grad(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
+                        self.fit_stats.count('gradient_evaluations')
+                predicted = self.twobind(x, params)
+                weighted_residuals = self.weights(x) * (predicted - actual)
+                return (np.dot(weighted_residuals, predicted - actual),
+                        2 * np.dot(weighted_residuals, self.twobind_jac(x, params, predicted)))
                 
 
         def twobind(self, x, params):
                 kd1, kd2 = params[self.param_ids['kd1']], params[self.param_ids['kd2']]
                 p1, p2 = params[self.param_ids['p1']], params[self.param_ids['p2']]
+                if self.fit_stats is not None:
+                        self.fit_stats.count('root_solver_calls')
+                        self.fit_stats.count('rows_solved', x.shape[0])
+                if self.root_engine == 'numpy':
+                        return self.numpy_free_drug(x, [kd1, kd2], [p1, p2])
                 coefficients = np.zeros((x.shape[0], 4))
                 coefficients[:,-1] = 1.0
                 coefficients[:,-2] = p1 + p2 + kd1 + kd2 - x
@@ -106,87 +400,621 @@ class protbind_model:
                 rootfind2(coefficients, x.shape[0], 4, predicted)
                 return predicted
 
+        #Solves for free drug with the NumPy root engine. During a fit we evaluate the same concentrations
+        #over and over with slowly changing parameters, so the last roots found for these concentrations
+        #make a very good starting point for the next solve.
+        def numpy_free_drug(self, x, kds, ps):
+                x = np.asarray(x, dtype=np.float64)
+                initial_guess = None
+                if self.warm_start_roots is not None:
+                        previous_x, previous_roots = self.warm_start_roots
+                        if previous_x.shape == x.shape and np.array_equal(previous_x, x):
+                                initial_guess = previous_roots
+                predicted = rootfinding.solve_free_drug(x, kds, ps, initial_guess)
+                self.warm_start_roots = (np.copy(x), predicted)
+                return predicted
+
+        #Derivatives of the predicted free drug with respect to kd1, p1, kd2 and p2. Rather than differentiating
+        #the cubic's coefficients we differentiate the binding equation implicitly at the root, which gives
+        #the same answer and is better conditioned. predicted may be passed in if it has already been found.
+        def twobind_jac(self, x, params, predicted = None):
+                if predicted is None:
+                        predicted = self.twobind(x, params)
+                kd1, kd2 = params[self.param_ids['kd1']], params[self.param_ids['kd2']]
+                p1, p2 = params[self.param_ids['p1']], params[self.param_ids['p2']]
+                sensitivities = rootfinding.free_drug_sensitivities(predicted, [kd1, kd2], [p1, p2])
+                jacobian = np.zeros((predicted.shape[0], 4))
+                for site, (dkd, dp) in enumerate(sensitivities):
+                        jacobian[:,self.param_ids['kd%s'%(site+1)]] = dkd
+                        jacobian[:,self.param_ids['p%s'%(site+1)]] = dp
+                return jacobian
+
+
+###These functions are for the three-site binding model
+
+        def threebind_resid(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
+                residuals = (self.threebind(x, params) - actual)
+                return np.sum(self.weights(x) * residuals * residuals)
+
+        def threebind_resid_grad(self, params, x, actual):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
+                        self.fit_stats.count('gradient_evaluations')
+                predicted = self.threebind(x, params)
+                weighted_residuals = self.weights(x) * (predicted - actual)
+                return (np.dot(weighted_residuals, predicted - actual),
+                        2 * np.dot(weighted_residuals, self.threebind_jac(x, params, predicted)))
+
+        #Clearing the denominators of the binding equation for three sites gives the quartic
+        #   F**4 + (a2 + b2 - x) F**3 + (a1 + b1 - x a2) F**2 + (a0 + b0 - x a1) F - x a0 = 0
+        #where a2, a1, a0 are the coefficients of (kd1 + F)(kd2 + F)(kd3 + F) = F**3 + a2 F**2 + a1 F + a0 and
+        #b2, b1, b0 those of p1 (kd2 + F)(kd3 + F) + p2 (kd1 + F)(kd3 + F) + p3 (kd1 + F)(kd2 + F).
+        def threebind(self, x, params):
+                kd1, kd2, kd3 = params[self.param_ids['kd1']], params[self.param_ids['kd2']], params[self.param_ids['kd3']]
+                p1, p2, p3 = params[self.param_ids['p1']], params[self.param_ids['p2']], params[self.param_ids['p3']]
+                if self.fit_stats is not None:
+                        self.fit_stats.count('root_solver_calls')
+                        self.fit_stats.count('rows_solved', x.shape[0])
+                if self.root_engine == 'numpy':
+                        return self.numpy_free_drug(x, [kd1, kd2, kd3], [p1, p2, p3])
+                a2, a1, a0 = kd1 + kd2 + kd3, kd1*kd2 + kd1*kd3 + kd2*kd3, kd1*kd2*kd3
+                b2 = p1 + p2 + p3
+                b1 = p1*(kd2 + kd3) + p2*(kd1 + kd3) + p3*(kd1 + kd2)
+                b0 = p1*kd2*kd3 + p2*kd1*kd3 + p3*kd1*kd2
+                coefficients = np.zeros((x.shape[0], 5))
+                coefficients[:,-1] = 1.0
+                coefficients[:,-2] = a2 + b2 - x
+                coefficients[:,-3] = a1 + b1 - x*a2
+                coefficients[:,-4] = a0 + b0 - x*a1
+                coefficients[:,-5] = -x*a0
+                predicted = np.zeros((x.shape[0]))
+                rootfind3(coefficients, x.shape[0], 5, predicted)
+                return predicted
+
+        #Derivatives of the predicted free drug with respect to kd1, p1, kd2, p2, kd3 and p3 (see twobind_jac).
+        def threebind_jac(self, x, params, predicted = None):
+                if predicted is None:
+                        predicted = self.threebind(x, params)
+                kds = [params[self.param_ids['kd%s'%(site+1)]] for site in range(3)]
+                ps = [params[self.param_ids['p%s'%(site+1)]] for site in range(3)]
+                sensitivities = rootfinding.free_drug_sensitivities(predicted, kds, ps)
+                jacobian = np.zeros((predicted.shape[0], 6))
+                for site, (dkd, dp) in enumerate(sensitivities):
+                        jacobian[:,self.param_ids['kd%s'%(site+1)]] = dkd
+                        jacobian[:,self.param_ids['p%s'%(site+1)]] = dp
+                return jacobian
+
+
+###Weights applied to each squared residual for the current weight type.
+        def weights(self, x):
+                if self.weight_type == 0:
+                        return np.ones(x.shape[0])
+                elif self.weight_type == 1:
+                        return 1/x
+                elif self.weight_type == 2:
+                        return 1/(x**2)
+                elif self.weight_type == 3:
+                        return 1/(x**3)
+
+###These functions are for the least squares optimizer backend, for any model and weight type.
+        #The weighted residual vector sqrt(w) * (predicted - actual), whose sum of squares is what the
+        #residual functions above return. predicted may be passed in if it has already been found.
+        def weighted_resid_vector(self, params, x, actual, predicted = None):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('residual_evaluations')
+                if predicted is None:
+                        predicted = {0:self.onebind, 1:self.twobind, 2:self.threebind}[self.model_type](x, params)
+                return np.sqrt(self.weights(x)) * (predicted - actual)
+
+        #Jacobian of weighted_resid_vector, one row per point and one column per parameter.
+        def weighted_resid_jac(self, params, x, actual, predicted = None):
+                if self.fit_stats is not None:
+                        self.fit_stats.count('gradient_evaluations')
+                jac_function = {0:self.onebind_jac, 1:self.twobind_jac, 2:self.threebind_jac}[self.model_type]
+                return np.sqrt(self.weights(x))[:, np.newaxis] * jac_function(x, params, predicted)
+
+
+
+
+        #Bootstrap confidence intervals for the fitted parameters and prediction curve; see bootstrap.py.
+        def bootstrap(self, num_replicates = 2000, seed = 0, num_workers = None, resample_type = 'cases',
+                      confidence = 0.95):
+                import bootstrap
+                return bootstrap.bootstrap_fit(self, num_replicates, seed, num_workers, resample_type, confidence)
 
+        #Raises fit_cancelled if someone has asked for the fit to stop. This is also passed to the optimizer as
+        #its callback so it gets checked after every iteration.
+        def check_cancelled(self, *args):
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                        raise fit_cancelled()
 
+        def report_progress(self, stage, done, total):
+                if self.progress_callback is not None:
+                        self.progress_callback(stage, done, total)
+
+        #Times a stage of the fit if instrumentation is on; does nothing otherwise.
+        def stage_timer(self, name):
+                if self.fit_stats is None:
+                        return contextlib.nullcontext()
+                return self.fit_stats.timer(name)
 
         ##This function is to fit a new model. Depending on the user's selected option for model fitting, we may
         #call one of several functions specific to certain model types.
         def model_fit(self):
                 try:
-                        x = np.asarray([float(z) for z in self.associated_data['total'].values])
-                        y = np.asarray([float(z) for z in self.associated_data['free'].values])
+                        x, y = self.fit_data()
                 except:
                         return ('could not convert data to numeric form! Are you sure your '
                                 'input protein binding dataset is only non-numeric characters?')
                 self.x_values_spanning_range = np.exp(np.arange(np.log(np.min(x)), np.log(np.max(x)), 0.1) )
-                residual_function_dict = {0:self.onebind_resid, 1:self.twobind_resid}
-                preds_function_dict = {0:self.onebind, 1:self.twobind}
+                self.clear_lookup_table()
+                self.bootstrap_results = None
+                self.fit_stats = instrumentation.fit_stats(self.instrumentation_callbacks) if self.instrumentation else None
+                self.from_cache = False
+                if self.fit_cache is not None:
+                        cache_key = self.fit_cache.key(self, x, y)
+                        if self.fit_cache.restore(cache_key, self):
+                                self.from_cache = True
+                                if self.fit_stats is not None:
+                                        self.fit_stats.count('fit_cache_hits')
+                                self.actual_free = np.copy(y)
+                                self.input_x_values = np.copy(x)
+                                return '0'
+                residual_function_dict = {0:self.onebind_resid, 1:self.twobind_resid, 2:self.threebind_resid}
+                preds_function_dict = {0:self.onebind, 1:self.twobind, 2:self.threebind}
+                gradient_function_dict = {0:self.onebind_resid_grad, 1:self.twobind_resid_grad,
+                                          2:self.threebind_resid_grad}
                 
-                self.binding_fitter(x, y, residual_function_dict[self.model_type],
-                                    preds_function_dict[self.model_type])
+                try:
+                        self.binding_fitter(x, y, residual_function_dict[self.model_type],
+                                            preds_function_dict[self.model_type],
+                                            gradient_function_dict[self.model_type])
+                except fit_cancelled:
+                        self.predicted_free = None
+                        return 'The fit was cancelled.'
                 self.actual_free = np.copy(y)
                 self.input_x_values = np.copy(x)
                 error_code = self.calc_error(x, y, residual_function_dict[self.model_type])
                 if error_code == '0':
+                        if self.fit_cache is not None:
+                                self.fit_cache.save(cache_key, self)
                         return '0'
                 else:
                         return error_code
-                
 
-        def binding_fitter(self, x, y, residual_function, pred_function):
+        ##Refits the model after points have been excluded or added. Dropping an outlier or adding a replicate
+        #hardly moves the optimum, so instead of a full search we polish the current parameters (polish_fit)
+        #and then recalculate the errors and AIC. We fall back on a full model_fit if the model hasn't been
+        #fitted yet, the polish doesn't converge, the error calculation fails or the refit has degraded:
+        #its residual variance is more than (1 + refit_tolerance) times that of the last fit (which suggests
+        #the old optimum no longer fits the data and a better one may be elsewhere). optimizer_stats says
+        #whether the fallback was needed. Refits are not stored in the fit cache, although the fallback can
+        #use it. Returns an error code like model_fit.
+        def refit(self):
+                num_params = len(self.model_associated_params[self.model_type])
+                if self.x_values_spanning_range is None or not np.all(self.params[0:num_params] > 0):
+                        return self.model_fit()
+                try:
+                        x, y = self.fit_data()
+                except:
+                        return ('could not convert data to numeric form! Are you sure your '
+                                'input protein binding dataset is only non-numeric characters?')
+                if x.shape[0] < num_params + 2:
+                        return ('Too few points are left to fit this model. Include some points again or use a less '
+                                'flexible model.')
+                residual_function = {0:self.onebind_resid, 1:self.twobind_resid, 2:self.threebind_resid}[self.model_type]
+                previous_variance = None
+                if getattr(self, 'input_x_values', None) is not None and self.input_x_values.shape[0] > num_params:
+                        previous_variance = (residual_function(self.params[0:num_params], self.input_x_values,
+                                                               self.actual_free) /
+                                             (self.input_x_values.shape[0] - num_params))
+                self.x_values_spanning_range = np.exp(np.arange(np.log(np.min(x)), np.log(np.max(x)), 0.1) )
+                self.clear_lookup_table()
+                self.bootstrap_results = None
+                self.fit_stats = instrumentation.fit_stats(self.instrumentation_callbacks) if self.instrumentation else None
+                self.from_cache = False
+                try:
+                        with self.stage_timer('refit'):
+                                ssbm = self.polish_fit(self.params[0:num_params], x, y)
+                except fit_cancelled:
+                        self.predicted_free = None
+                        return 'The fit was cancelled.'
+                self.optimizer_stats = {'gradient_type':'analytic', 'search_type':'refit',
+                                        'optimizer_backend':'polish', 'starts':1,
+                                        'iterations':ssbm.nit, 'function_evaluations':ssbm.nfev, 'refit_fallback':False}
+                if self.fit_stats is not None:
+                        self.fit_stats.record_start(ssbm.nit, ssbm.nfev)
+                degraded = not ssbm.success
+                if not degraded and previous_variance is not None:
+                        degraded = ssbm.fun / (x.shape[0] - num_params) > (1 + self.refit_tolerance) * previous_variance
+                if not degraded:
+                        self.params = np.zeros((6))
+                        self.params[0:num_params] = self.sort_sites(ssbm.x[np.newaxis, :])[0]
+                        self.actual_free = np.copy(y)
+                        self.input_x_values = np.copy(x)
+                        degraded = self.calc_error(x, y, residual_function) != '0'
+                if degraded:
+                        print('The refit has degraded; falling back on a full fit.')
+                        error_code = self.model_fit()
+                        #The stats belong to the full fit (or to the cached fit it was restored from), so they are
+                        #copied rather than marked in place, and a cached result's stats aren't passed off as ours.
+                        if self.from_cache:
+                                self.optimizer_stats = {'search_type':'refit', 'from_cache':True}
+                        else:
+                                self.optimizer_stats = dict(self.optimizer_stats)
+                        self.optimizer_stats['refit_fallback'] = True
+                        return error_code
+                with self.stage_timer('prediction_curve'):
+                        self.predicted_free, _ = self.make_preds(self.x_values_spanning_range)
+                return '0'
+
+
+        def binding_fitter(self, x, y, residual_function, pred_function, gradient_function = None):
                 print('Beginning fit')
-                self.grid_search(x,y,residual_function)
-                self.predicted_free, _ = self.make_preds(self.x_values_spanning_range)
+                with self.stage_timer('search'):
+                        if self.search_type == 'multistart':
+                                self.multistart_search(x, y, residual_function, gradient_function)
+                        else:
+                                self.grid_search(x,y,residual_function, gradient_function)
+                with self.stage_timer('prediction_curve'):
+                        self.predicted_free, _ = self.make_preds(self.x_values_spanning_range)
                 print('Fit complete.')
 
-        def grid_search(self, x, y, residual_function):
-                self.params = np.zeros((4))
-                if self.model_type == 0:
-                        param_grid = {'kd1':[1, 10.0, 100], 'p1':[5.0, 50, 500]}
-                if self.model_type == 1:
-                        param_grid = {'kd1':[1, 10.0, 100], 'p1':[1.0, 10, 100],
-                                      'kd2':[10, 100, 1000], 'p2':[10.0, 100, 1000]}
-                        
-                start_parameters = ParameterGrid(param_grid)
-                bounds = [(1e-10, None) for j in range(0, len(self.model_associated_params[self.model_type]))]
-                best_params = np.zeros((len(bounds)))
+        #Runs the local optimizer (see optimizer_backend) from one starting point and returns scipy's result, with
+        #fun the weighted sum of squares and nit the number of iterations whichever backend was used. With
+        #'least-squares' the Jacobian is always wanted at the point whose residuals were just found, so the free
+        #drug solved for the residuals is kept and reused rather than solved for again.
+        def local_fit(self, objective_function, use_jac, start, x, y):
+                bounds = [(1e-10, None) for j in range(0, start.shape[0])]
+                if self.optimizer_backend == 'l-bfgs-b':
+                        from scipy.optimize import minimize
+                        return minimize(objective_function, x0=start, args=(x, y), method='L-BFGS-B', bounds=bounds,
+                                        jac=use_jac, callback=self.check_cancelled)
+                if self.optimizer_backend != 'least-squares':
+                        raise ValueError('Unknown optimizer backend %s'%self.optimizer_backend)
+                from scipy.optimize import least_squares
+                preds_function = {0:self.onebind, 1:self.twobind, 2:self.threebind}[self.model_type]
+                last_evaluation = {}
+                def residuals(params):
+                        self.check_cancelled()
+                        last_evaluation['params'] = np.copy(params)
+                        last_evaluation['predicted'] = preds_function(x, params)
+                        return self.weighted_resid_vector(params, x, y, last_evaluation['predicted'])
+                def jacobian(params):
+                        predicted = None
+                        if np.array_equal(params, last_evaluation.get('params')):
+                                predicted = last_evaluation['predicted']
+                        return self.weighted_resid_jac(params, x, y, predicted)
+                ssbm = least_squares(residuals, start, jac=jacobian if use_jac else '2-point', bounds=(1e-10, np.inf),
+                                     method='trf', x_scale='jac')
+                ssbm.fun = 2 * ssbm.cost
+                ssbm.nit = ssbm.njev
+                return ssbm
+
+        #Polishes a fit from a start that is already close to the optimum (a refit after editing the points, or a
+        #bootstrap replicate). From such a start L-BFGS-B on the raw parameters tends to stop after an iteration
+        #or two when the fit is weighted, since the objective is tiny and the parameters differ in scale by orders
+        #of magnitude. So here Levenberg-Marquardt works on the weighted residual vector as a function of the logs
+        #of the parameters, which is well scaled whatever the weighting and keeps the parameters positive without
+        #bounds, with tight tolerances. The result is like local_fit's, except that success also requires the
+        #fit to have really converged: in log space (so that the test doesn't depend on the scale of the
+        #parameters or the weights) the projected gradient must be within gradient_tolerance of zero relative to
+        #the objective, or else a Gauss-Newton step from the end point must promise to lower the objective by no
+        #more than reduction_tolerance times its value, i.e. to move the parameters by well under a hundredth of
+        #a standard error.
+        #
+        #Many real fits are degenerate: a site whose kd and capacity run off to infinity together (a site that
+        #never saturates) or a kd heading for zero. The optimum is then never reached, so if Levenberg-Marquardt
+        #doesn't converge the fit is finished by a bounded trust region search between 1e-10 (the full fit's
+        #lower bound) and 1e10, and the test ignores parameters sitting at (within 1% of) a bound they are
+        #pushing against, as well as directions along which the objective is flat to rounding error (singular
+        #values of the Jacobian below 1e-7 of the largest).
+        def polish_fit(self, start, x, y, gradient_tolerance = 1e-6, reduction_tolerance = 1e-6):
+                from scipy.optimize import least_squares
+                preds_function = {0:self.onebind, 1:self.twobind, 2:self.threebind}[self.model_type]
+                last_evaluation = {}
+                lower_bound, upper_bound = np.log(1e-10), np.log(1e10)
+                def residuals(log_params):
+                        self.check_cancelled()
+                        params = np.exp(log_params)
+                        last_evaluation['log_params'] = np.copy(log_params)
+                        last_evaluation['predicted'] = preds_function(x, params)
+                        return self.weighted_resid_vector(params, x, y, last_evaluation['predicted'])
+                def jacobian(log_params):
+                        predicted = None
+                        if np.array_equal(log_params, last_evaluation.get('log_params')):
+                                predicted = last_evaluation['predicted']
+                        params = np.exp(log_params)
+                        return self.weighted_resid_jac(params, x, y, predicted) * params[np.newaxis, :]
+                def converged(ssbm):
+                        if not (np.all(np.isfinite(ssbm.x)) and np.all(np.isfinite(ssbm.fun))):
+                                return False
+                        objective = max(np.sum(ssbm.fun**2), 1e-300)
+                        gradient = np.dot(ssbm.jac.T, ssbm.fun)
+                        on_bound = ((ssbm.x <= lower_bound + 1e-2) & (gradient > 0)) | \
+                                   ((ssbm.x >= upper_bound - 1e-2) & (gradient < 0))
+                        if np.max(np.abs(gradient[~on_bound]), initial=0.0) <= gradient_tolerance * objective:
+                                return True
+                        free_jac = ssbm.jac[:, ~on_bound]
+                        step = np.linalg.lstsq(free_jac, -ssbm.fun, rcond=1e-7)[0]
+                        return bool(np.sum(np.dot(free_jac, step)**2) <= reduction_tolerance * objective)
+                with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                        ssbm = least_squares(residuals, np.log(np.maximum(start, 1e-10)), jac=jacobian, method='lm',
+                                             ftol=1e-12, xtol=1e-12, gtol=1e-12)
+                        success = converged(ssbm)
+                        if not success and np.all(np.isfinite(ssbm.x)):
+                                #No xtol here: it is relative to the norm of all the parameters, so a kd
+                                #parked at 1e10 would stop the search before the others have converged.
+                                evaluations = ssbm.nfev, ssbm.njev
+                                ssbm = least_squares(lambda params: residuals(np.log(params)),
+                                                     np.clip(np.exp(ssbm.x), 1e-10, 1e10),
+                                                     jac=lambda params: jacobian(np.log(params)) / params[np.newaxis, :],
+                                                     method='trf', bounds=(1e-10, 1e10), x_scale='jac',
+                                                     ftol=1e-12, xtol=None, gtol=1e-12)
+                                ssbm.jac = ssbm.jac * ssbm.x[np.newaxis, :]
+                                ssbm.x = np.log(ssbm.x)
+                                ssbm.nfev, ssbm.njev = ssbm.nfev + evaluations[0], ssbm.njev + evaluations[1]
+                                success = converged(ssbm)
+                ssbm.x = np.exp(ssbm.x)
+                ssbm.fun = 2 * ssbm.cost
+                ssbm.nit = ssbm.njev
+                ssbm.success = bool(success and np.isfinite(ssbm.fun))
+                return ssbm
+
+        #If gradient_function is supplied (it must return the objective and its gradient) and gradient_type is
+        #'analytic' the optimizer uses it; otherwise it falls back to finite differences.
+        def grid_search(self, x, y, residual_function, gradient_function = None):
+                self.params = np.zeros((6))
+                if gradient_function is not None and self.gradient_type == 'analytic':
+                        objective_function, use_jac = gradient_function, True
+                else:
+                        objective_function, use_jac = residual_function, None
+                self.optimizer_stats = {'gradient_type':'analytic' if use_jac else 'numerical',
+                                        'optimizer_backend':self.optimizer_backend,
+                                        'starts':0, 'iterations':0, 'function_evaluations':0}
+                start_parameters = self.start_points()
+                best_params = np.zeros((start_parameters.shape[1]))
                 best_fun = -1
                 for j in range(0, len(start_parameters)):
-                        current_starting_params = [start_parameters[j][param] for param in
-                                                   self.model_associated_params[self.model_type]]
-                        ssbm = minimize(residual_function, x0=current_starting_params, args=(x, y), 
-                                                                method='L-BFGS-B', bounds=bounds)
+                        current_starting_params = start_parameters[j]
+                        ssbm = self.local_fit(objective_function, use_jac, current_starting_params, x, y)
+                        self.optimizer_stats['starts'] += 1
+                        self.optimizer_stats['iterations'] += ssbm.nit
+                        self.optimizer_stats['function_evaluations'] += ssbm.nfev
+                        if self.fit_stats is not None:
+                                self.fit_stats.record_start(ssbm.nit, ssbm.nfev)
                         if ssbm.success == True:
                                 if best_fun < 0 or ssbm.fun < best_fun:
                                         best_fun = ssbm.fun
                                         best_params = ssbm.x
+                        self.report_progress('grid', j + 1, len(start_parameters))
                         if j % 25 == 0:
                                 print('%s iterations'%j)
                 item_counter = 0
                 for j, current_param in enumerate(self.model_associated_params[self.model_type]):
                         self.params[self.param_ids[current_param]] = best_params[j]
                 print(self.params)
+                print('%(iterations)s optimizer iterations, %(function_evaluations)s function evaluations '
+                      '(%(gradient_type)s gradients)'%self.optimizer_stats)
+
+
+        def start_grid(self):
+                if self.model_type == 0:
+                        param_grid = {'kd1':[1, 10.0, 100], 'p1':[5.0, 50, 500]}
+                if self.model_type == 1:
+                        param_grid = {'kd1':[1, 10.0, 100], 'p1':[1.0, 10, 100],
+                                      'kd2':[10, 100, 1000], 'p2':[10.0, 100, 1000]}
+                if self.model_type == 2:
+                        param_grid = {'kd1':[0.1, 1.0, 10], 'p1':[1.0, 10, 100],
+                                      'kd2':[1, 10.0, 100], 'p2':[10.0, 100, 1000],
+                                      'kd3':[100, 1000.0, 10000], 'p3':[10.0, 100, 1000]}
+                return param_grid
+
+        #Starting points for the fit, one row per start in model_associated_params order. With start_type
+        #'grid' these are the points of start_grid; with 'sobol' or 'latin_hypercube' they are start_budget
+        #quasi-random points spread in log space over the box spanned by start_grid, which covers the space
+        #far more evenly than a grid of the same size. 'auto' uses the grid unless it would have more than
+        #start_budget points. The quasi-random points are seeded so that refitting gives the same answer.
+        def start_points(self):
+                settings = self.multistart_settings
+                associated_params = self.model_associated_params[self.model_type]
+                param_grid = self.start_grid()
+                start_type = settings['start_type']
+                if start_type == 'auto':
+                        grid_size = np.prod([len(param_grid[param]) for param in associated_params])
+                        start_type = 'grid' if grid_size <= settings['start_budget'] else 'sobol'
+                if start_type == 'grid':
+                        return np.asarray([[start[param] for param in associated_params]
+                                           for start in parameter_grid(param_grid)], dtype=np.float64)
+                from scipy.stats import qmc
+                if start_type == 'sobol':
+                        sampler = qmc.Sobol(len(associated_params), seed=0)
+                        unit_points = sampler.random_base2(int(np.ceil(np.log2(settings['start_budget']))))
+                        unit_points = unit_points[0:settings['start_budget']]
+                elif start_type == 'latin_hypercube':
+                        unit_points = qmc.LatinHypercube(len(associated_params), seed=0).random(settings['start_budget'])
+                else:
+                        raise ValueError('Unknown start type %s'%start_type)
+                log_lower = np.log([np.min(param_grid[param]) for param in associated_params])
+                log_upper = np.log([np.max(param_grid[param]) for param in associated_params])
+                return np.exp(qmc.scale(unit_points, log_lower, log_upper))
+
+        #Predicted free drug for many parameter sets at once: param_matrix has one row per parameter set (in
+        #model_associated_params order) and the result has one row per parameter set and one column per
+        #concentration. The two and three-site models always use the NumPy root engine here since that is what
+        #lets us solve every row in one pass. Also returns the per-site kd and p columns for reuse.
+        def batch_preds(self, param_matrix, x):
+                num_sites = param_matrix.shape[1] // 2
+                kds = [param_matrix[:, [2*site]] for site in range(num_sites)]
+                ps = [param_matrix[:, [2*site + 1]] for site in range(num_sites)]
+                if self.model_type == 0:
+                        predicted = self.onebind(x[np.newaxis, :], [kds[0], ps[0]])
+                else:
+                        predicted = rootfinding.solve_free_drug(x[np.newaxis, :], kds, ps)
+                        if self.fit_stats is not None:
+                                self.fit_stats.count('root_solver_calls')
+                                self.fit_stats.count('rows_solved', predicted.size)
+                return predicted, kds, ps
+
+        #The binding sites are interchangeable, so (kd1, p1, kd2, p2) and (kd2, p2, kd1, p1) are the same fit.
+        #We put the sites of each row of param_matrix in order of increasing kd so that mirrored solutions can
+        #be recognized as duplicates and site 1 is always the high affinity site.
+        def sort_sites(self, param_matrix):
+                sites = param_matrix.reshape(param_matrix.shape[0], -1, 2)
+                order = np.argsort(sites[:, :, 0], axis=1)
+                return np.take_along_axis(sites, order[:, :, np.newaxis], axis=1).reshape(param_matrix.shape)
+
+        ##Multistart search. All the starting points from start_grid are moved together through a few damped
+        #Gauss-Newton (Levenberg-Marquardt) steps in log-parameter space, each step being a single array pass
+        #over (starting points x concentrations). The starts are then ranked; any start that ends up within
+        #dedupe_tolerance (in log space) of a better one is taken to be in the same basin and dropped, as is
+        #any start whose objective is more than (1 + prune_tolerance) times the best, and at most
+        #max_survivors starts are kept. Only the survivors get a full local fit. If none of those
+        #succeed we fall back on the full grid search. The statistics (including how many starts were merged
+        #as duplicates or pruned) are left in optimizer_stats.
+        def multistart_search(self, x, y, residual_function, gradient_function = None):
+                settings = self.multistart_settings
+                self.params = np.zeros((6))
+                if gradient_function is not None and self.gradient_type == 'analytic':
+                        objective_function, use_jac = gradient_function, True
+                else:
+                        objective_function, use_jac = residual_function, None
+                associated_params = self.model_associated_params[self.model_type]
+                current = self.start_points()
+                num_starts, num_params = current.shape
+                sqrt_weights = np.sqrt(self.weights(x))
+                stats = {'gradient_type':'analytic' if use_jac else 'numerical', 'search_type':'multistart',
+                         'optimizer_backend':self.optimizer_backend,
+                         'starts':num_starts, 'batched_evaluations':num_starts, 'duplicates':0, 'pruned':0,
+                         'refined':0, 'iterations':0, 'function_evaluations':0}
+
+                predicted, kds, ps = self.batch_preds(current, x)
+                residuals = sqrt_weights * (predicted - y)
+                objective = np.sum(residuals * residuals, axis=1)
+                damping = np.full(num_starts, 1e-3)
+                for probe_iteration in range(settings['probe_iterations']):
+                        self.check_cancelled()
+                        sensitivities = rootfinding.free_drug_sensitivities(predicted, kds, ps)
+                        jacobian = np.stack([d for site in sensitivities for d in site], axis=-1)
+                        jacobian = jacobian * sqrt_weights[:, np.newaxis] * current[:, np.newaxis, :]
+                        jtj = np.einsum('pni,pnj->pij', jacobian, jacobian)
+                        gradient = np.einsum('pni,pn->pi', jacobian, residuals)
+                        diagonal = np.einsum('pii->pi', jtj)
+                        system = jtj + damping[:, np.newaxis, np.newaxis] * (diagonal[:, :, np.newaxis] *
+                                                                             np.eye(num_params))
+                        step = -np.einsum('pij,pj->pi', np.linalg.pinv(system), gradient)
+                        trial = np.maximum(current * np.exp(np.clip(step, -5, 5)), 1e-10)
+                        trial_predicted, _, _ = self.batch_preds(trial, x)
+                        trial_residuals = sqrt_weights * (trial_predicted - y)
+                        trial_objective = np.sum(trial_residuals * trial_residuals, axis=1)
+                        stats['batched_evaluations'] += num_starts
+                        improved = np.isfinite(trial_objective) & (trial_objective < objective)
+                        current[improved] = trial[improved]
+                        predicted[improved] = trial_predicted[improved]
+                        residuals[improved] = trial_residuals[improved]
+                        objective[improved] = trial_objective[improved]
+                        damping = np.where(improved, damping / 3, damping * 2)
+                        kds = [current[:, [2*site]] for site in range(num_params // 2)]
+                        ps = [current[:, [2*site + 1]] for site in range(num_params // 2)]
+                        self.report_progress('probe', probe_iteration + 1, settings['probe_iterations'])
+
+                objective = np.where(np.isfinite(objective), objective, np.inf)
+                current = self.sort_sites(current)
+                log_current = np.log(current)
+                survivors = []
+                best_objective = np.min(objective)
+                for index in np.argsort(objective, kind='stable'):
+                        if any(np.max(np.abs(log_current[index] - log_current[kept])) < settings['dedupe_tolerance']
+                               for kept in survivors):
+                                stats['duplicates'] += 1
+                        elif (not np.isfinite(objective[index]) or len(survivors) >= settings['max_survivors']
+                              or objective[index] > best_objective * (1 + settings['prune_tolerance'])):
+                                stats['pruned'] += 1
+                        else:
+                                survivors.append(index)
+
+                best_params = None
+                best_fun = -1
+                for index in survivors:
+                        ssbm = self.local_fit(objective_function, use_jac, current[index], x, y)
+                        stats['refined'] += 1
+                        self.report_progress('refine', stats['refined'], len(survivors))
+                        stats['iterations'] += ssbm.nit
+                        stats['function_evaluations'] += ssbm.nfev
+                        if self.fit_stats is not None:
+                                self.fit_stats.record_start(ssbm.nit, ssbm.nfev)
+                        if ssbm.success == True:
+                                if best_fun < 0 or ssbm.fun < best_fun:
+                                        best_fun = ssbm.fun
+                                        best_params = ssbm.x
+                if best_params is None:
+                        print('Multistart search failed to converge; falling back on the full grid search.')
+                        self.grid_search(x, y, residual_function, gradient_function)
+                        return
+                best_params = self.sort_sites(best_params[np.newaxis, :])[0]
+                for j, current_param in enumerate(associated_params):
+                        self.params[self.param_ids[current_param]] = best_params[j]
+                self.optimizer_stats = stats
+                print(self.params)
+                print('%(starts)s starts: %(duplicates)s duplicates, %(pruned)s pruned, %(refined)s refined with '
+                      '%(function_evaluations)s function evaluations'%stats)
 
 
         def calc_error(self, x, y, residual_fun):
+                self.fit_warning = None
                 net_residuals = residual_fun(self.params, x, y)
                 num_params = len(self.model_associated_params[self.model_type])
                 degrees_of_freedom = x.shape[0] - num_params
-                hess_calculator = numdifftools.Hessian(residual_fun)
-                hessian = hess_calculator(self.params[0:num_params], x, y)
+                with self.stage_timer('hessian'):
+                        if self.hessian_type == 'numerical':
+                                import numdifftools
+                                hess_calculator = numdifftools.Hessian(residual_fun)
+                                hessian = hess_calculator(self.params[0:num_params], x, y)
+                        else:
+                                hessian = self.analytic_hessian(x, y)
                 hessian_eigenvalues = np.linalg.eig(hessian)[0]
-                cov_mat = np.linalg.inv(hessian)
-                if np.min(cov_mat) < 0:
+                try:
+                        cov_mat = np.linalg.inv(hessian)
+                except np.linalg.LinAlgError:
+                        cov_mat = -np.ones(hessian.shape)
+                #Only the variances have to be positive; the covariances between parameters (which are often
+                #negative for the multi-site models) don't.
+                if np.min(np.diag(cov_mat)) < 0:
                         return ("There was an error inverting the Hessian; the problem is likely ill-posed."
                                       "Try using a less flexible model with fewer free-to-vary parameters.")
+                self.covariance = cov_mat
                 for i in range(0, num_params):
                         self.param_errors[i] = np.sqrt((net_residuals / degrees_of_freedom)
                                                                * cov_mat[i,i])
                 self.AIC = net_residuals + 2*num_params + 2*num_params*(num_params+1)/(x.shape[0]-num_params-1)
+                #We don't pop up a warning from here so the model can be fitted without a GUI (e.g. in batch
+                #mode); the caller is responsible for showing fit_warning to the user if it is set.
                 if (np.max(hessian_eigenvalues) / np.min(hessian_eigenvalues)) > 1e8:
-                        alert = QMessageBox()
-                        alert.setText("The Hessian is ill-conditioned; error calculations may not be reliable."
-                                      "The problem is likely ill-posed. Do not use this result.")
-                        alert.setWindowTitle('Protein Fitter')
-                        alert.exec_()
+                        self.fit_warning = ("The Hessian is ill-conditioned; error calculations may not be reliable."
+                                            "The problem is likely ill-posed. Do not use this result.")
                 return '0'
+
+
+        #Hessian of the weighted sum of squares at the current parameters, built from the model sensitivities:
+        #H = 2 J^T W J + 2 sum(w * residual * d2F), where the second term is dropped for Gauss-Newton.
+        def analytic_hessian(self, x, y):
+                num_params = len(self.model_associated_params[self.model_type])
+                params = self.params[0:num_params]
+                if self.model_type == 0:
+                        predicted = self.onebind(x, params)
+                        jacobian = self.onebind_jac(x, params)
+                elif self.model_type == 1:
+                        predicted = self.twobind(x, params)
+                        jacobian = self.twobind_jac(x, params, predicted)
+                else:
+                        predicted = self.threebind(x, params)
+                        jacobian = self.threebind_jac(x, params, predicted)
+                weights = self.weights(x)
+                hessian = 2 * np.dot(jacobian.T * weights, jacobian)
+                if self.hessian_type == 'exact':
+                        kds, ps = self.site_params(params)
+                        second_derivatives = rootfinding.free_drug_second_derivatives(predicted, kds, ps)
+                        hessian = hessian + 2 * np.einsum('n,nij->ij', weights * (predicted - y), second_derivatives)
+                return hessian
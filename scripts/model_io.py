@@ -0,0 +1,123 @@
+import numpy as np, json, pickle, zipfile, argparse, os
+import model_building
+
+#Saving and loading fitted models. Models used to be saved by pickling the whole protbind_model, which
+#drags along the raw dataset, needs pandas and the exact class definition to load, and grows with the size
+#of the dataset. Instead we now save a small versioned file: a numpy .npz archive holding a JSON header
+#(model type, weighting, settings and other scalars) plus the arrays needed to use the model (parameters,
+#errors, covariance, prediction curve and lookup table if one was built). The training data is optional
+#and stored as separate arrays which are only read if something asks for the model's associated_data, so
+#loading a model for scoring doesn't touch it at all. Points excluded from the fit are saved with the training
+#data as a mask. Old pickled .model files are still read by load_model and can be converted with
+#migrate_model_file.
+
+model_file_format = 'pb_fitter_model'
+model_file_version = 1
+
+header_attributes = ['model_type', 'weight_type', 'error_type', 'AIC', 'plot_color', 'plot_title', 'fit_warning',
+                     'root_engine', 'gradient_type', 'hessian_type', 'search_type', 'optimizer_backend',
+                     'multistart_settings', 'use_lookup_table', 'refit_tolerance']
+array_attributes = ['params', 'param_errors', 'covariance', 'x_values_spanning_range', 'predicted_free']
+lookup_arrays = ['log_total', 'log_free', 'log_slopes']
+lookup_scalars = ['min_total', 'max_total', 'max_relative_error']
+
+
+#Converts numpy scalars to plain python types so they can go in the JSON header.
+def to_json_value(value):
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, dict):
+    return {key:to_json_value(item) for key, item in value.items()}
+  return value
+
+
+def save_model(pb_model, filename, include_training_data = True):
+  header = {'format':model_file_format, 'version':model_file_version}
+  for attribute in header_attributes:
+    header[attribute] = to_json_value(getattr(pb_model, attribute))
+  arrays = {}
+  for attribute in array_attributes:
+    if getattr(pb_model, attribute) is not None:
+      arrays[attribute] = np.asarray(getattr(pb_model, attribute), dtype=np.float64)
+  if pb_model.lookup_table is not None:
+    header['lookup_table'] = {key:to_json_value(pb_model.lookup_table[key]) for key in lookup_scalars}
+    for key in lookup_arrays:
+      arrays['lookup_%s'%key] = pb_model.lookup_table[key]
+  header['has_training_data'] = False
+  if include_training_data and pb_model.associated_data is not None:
+    arrays['data_total'] = np.asarray(pb_model.associated_data['total'].values, dtype=np.float64)
+    arrays['data_free'] = np.asarray(pb_model.associated_data['free'].values, dtype=np.float64)
+    if pb_model.excluded_points is not None:
+      arrays['data_excluded'] = np.asarray(pb_model.excluded_points, dtype=bool)
+    header['has_training_data'] = True
+  #np.savez would add .npz to a filename without it, so we write to an open file instead.
+  with open(filename, 'wb') as output_model:
+    np.savez(output_model, header=np.array(json.dumps(header)), **arrays)
+
+
+#Loads a model saved by save_model, or an old pickled model. With load_training_data False the dataset is
+#left on disk and only read if the model's associated_data is used.
+def load_model(filename, load_training_data = False):
+  if not zipfile.is_zipfile(filename):
+    with open(filename, 'rb') as input_model:
+      return pickle.load(input_model)
+  with np.load(filename, allow_pickle=False) as model_file:
+    header = json.loads(str(model_file['header']))
+    if header.get('format') != model_file_format:
+      raise ValueError('%s is not a protein binding model file.'%filename)
+    if header['version'] > model_file_version:
+      raise ValueError('%s was saved by a newer version of this program (model file version %s).'%
+                       (filename, header['version']))
+    pb_model = model_building.protbind_model(model_type = header['model_type'], weight_type = header['weight_type'],
+                                             error_type = header['error_type'])
+    for attribute in header_attributes:
+      if attribute == 'multistart_settings':
+        #Files saved before a setting was added keep the default for it.
+        pb_model.multistart_settings.update(header[attribute])
+      elif attribute in header:
+        #Likewise for settings added since (e.g. optimizer_backend).
+        setattr(pb_model, attribute, header[attribute])
+    for attribute in array_attributes:
+      if attribute in model_file.files:
+        setattr(pb_model, attribute, model_file[attribute])
+    if 'lookup_table' in header:
+      pb_model.lookup_table = dict(header['lookup_table'])
+      for key in lookup_arrays:
+        pb_model.lookup_table[key] = model_file['lookup_%s'%key]
+    if header['has_training_data']:
+      if load_training_data:
+        pb_model.associated_data = read_training_data(filename, pb_model)
+      else:
+        pb_model.data_loader = lambda: read_training_data(filename, pb_model)
+      if 'data_excluded' in model_file.files:
+        pb_model.excluded_points = np.asarray(model_file['data_excluded'], dtype=bool)
+  return pb_model
+
+
+def read_training_data(filename, pb_model):
+  import pandas as pd
+  with np.load(filename, allow_pickle=False) as model_file:
+    total, free = model_file['data_total'], model_file['data_free']
+    included = np.ones(total.shape[0], dtype=bool)
+    if 'data_excluded' in model_file.files:
+      included = ~model_file['data_excluded']
+  pb_model.input_x_values = np.copy(total[included])
+  pb_model.actual_free = np.copy(free[included])
+  return pd.DataFrame({'total':total, 'free':free})
+
+
+#Rewrites an old pickled model (or a model in an older file version) in the current format. If no new
+#filename is given the file is converted in place.
+def migrate_model_file(filename, new_filename = None):
+  pb_model = load_model(filename, load_training_data = True)
+  save_model(pb_model, filename if new_filename is None else new_filename)
+  return pb_model
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert old pickled .model files to the current model file format.')
+  parser.add_argument('models', nargs='+', help='Model files to convert in place')
+  args = parser.parse_args()
+  for filename in args.models:
+    migrate_model_file(filename)
+    print('Converted %s (%s bytes)'%(filename, os.path.getsize(filename)))
@@ -1,30 +1,57 @@
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import QApplication, QLabel, QWidget, QPushButton, QVBoxLayout, QMainWindow, QMessageBox, QFileDialog
-from PyQt5.QtWidgets import QLineEdit, QHBoxLayout, QCheckBox, QComboBox
+from PyQt5.QtWidgets import QLineEdit, QHBoxLayout, QCheckBox, QComboBox, QProgressBar
 from PyQt5.QtGui import QPixmap
-import pandas as pd, numpy as np, scipy, model_building, plotting, pickle, os
-from scipy import optimize
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
+import pandas as pd, numpy as np, model_building, model_io, plotting, pk_calc, fit_cache, os, threading, copy
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
+#Runs a slow job (a fit or a PK calculation) off the GUI thread so the window stays responsive. The job is
+#called with a function it can use to report progress as (stage, done, total); progress and the job's result
+#(or the exception it raised) come back to the GUI thread through Qt signals.
+class background_task(QtCore.QThread):
+  progress = QtCore.pyqtSignal(str, int, int)
+  finished_with = QtCore.pyqtSignal(object)
+
+  def __init__(self, job):
+    super().__init__()
+    self.job = job
+
+  def run(self):
+    try:
+      result = self.job(self.progress.emit)
+    except Exception as err:
+      result = err
+    self.finished_with.emit(result)
+
+
 class protfitter(QMainWindow):
 
   def __init__(self):
     super().__init__()
+    #Refitting the same data with the same settings reuses the previous result instead of fitting again.
+    self.fit_cache = fit_cache.fit_cache()
     self.current_model = model_building.protbind_model()
+    self.current_model.fit_cache = self.fit_cache
     self.current_data = pd.DataFrame()
     self.weight_options = {'No weighting':0, '1/C weighting':1, '1/(C^2) weighting':2,
                            '1/(C^3) weighting':3}
-    self.regression_options = {'One-binding site model':0, 'Two-binding site model':1}
+    self.regression_options = {'One-binding site model':0, 'Two-binding site model':1,
+                               'Three-binding site model':2}
     
     self.current_model_selection = self.regression_options['One-binding site model']
     self.current_weight_selection = self.weight_options['No weighting']
     self.color_options = {'Blue':'b', 'Green':'g', 'Red':'r', 'Orange':'orange'}
     self.color_index = {'b':0, 'g':1, 'r':2}
+    self.progress_stages = {'grid':'Fitting from starting point %s of %s', 'probe':'Exploring starting points (%s of %s)',
+                            'refine':'Refining best starting point %s of %s', 'pk':'%s rows written'}
+    self.current_task = None
+    self.cancel_event = threading.Event()
 
     self.central_plot = Figure(figsize=(15,5))
     self.canvas = FigureCanvas(self.central_plot)
+    self.canvas.mpl_connect('pick_event', self.toggle_point)
     self.toolbar = NavigationToolbar(self.canvas, self)
     
     self.setWindowTitle('Protein Binding Fitter')
@@ -51,12 +78,25 @@ class protfitter(QMainWindow):
     left_panel.addWidget(fit_button)
     fit_button.clicked.connect(self.fit_pb_data)
 
+    self.exclude_checkbox = QCheckBox('Click points to exclude / include them')
+    left_panel.addWidget(self.exclude_checkbox)
+
+    self.progress_label = QLabel('')
+    left_panel.addWidget(self.progress_label)
+    self.progress_bar = QProgressBar()
+    left_panel.addWidget(self.progress_bar)
+    self.cancel_button = QPushButton('Cancel')
+    self.cancel_button.setEnabled(False)
+    left_panel.addWidget(self.cancel_button)
+    self.cancel_button.clicked.connect(self.cancel_task)
+
     model_label = QLabel('Model fitting options')
     left_panel.addWidget(model_label)
     
     self.regression_type = QComboBox()
     self.regression_type.addItem("One-binding site model")
     self.regression_type.addItem("Two-binding site model")
+    self.regression_type.addItem("Three-binding site model")
     self.regression_type.activated[str].connect(self.change_regression_type)
     left_panel.addWidget(self.regression_type)
 
@@ -91,6 +131,14 @@ class protfitter(QMainWindow):
     left_panel.addWidget(pk_calc_button)
     pk_calc_button.clicked.connect(self.run_pk_calcs)
 
+    timing_button = QPushButton('Show timing breakdown for last fit')
+    left_panel.addWidget(timing_button)
+    timing_button.clicked.connect(self.show_timing_breakdown)
+
+    #Everything that would change or use the current model is switched off while a background task runs.
+    self.task_widgets = [import_button, fit_button, self.exclude_checkbox, self.regression_type, self.weight_type, self.color_palette,
+                         save_button, load_button, pk_calc_button, timing_button]
+
     top_panel.addLayout(left_panel)
     top_panel.addLayout(right_panel)
     
@@ -107,34 +155,44 @@ class protfitter(QMainWindow):
     filename, _ = QFileDialog.getOpenFileName(self,"Load a csv file containing PK data",
             "","csv files (*.csv);;", options=options)
     if filename:
-      try:
-        input_pk_data = pd.read_csv(filename, header=None)
-        total_concentrations = input_pk_data.values[:,0].astype(float)
-      except:
-        self.sudden_death("There was an error reading your file. Are you sure there's no text in column 1? Are you "
-                          "SURE it's a csv?")
-      try:
-        free_concentrations, error_code = self.current_model.make_preds(total_concentrations)
-        output_dict = {'Total concentration':total_concentrations, 'Free concentration':free_concentrations}
-        output_df = pd.DataFrame.from_dict(output_dict)
-      except:
+      if self.current_model.make_preds(np.ones(1))[1] != '0':
         self.sudden_death("There was an error generating the output. Data has not been saved. Make sure you have a model "
                           "fitted/loaded before attempting to run PK calculations.")
+        return
       options = QFileDialog.Options()
-      filename, _ = QFileDialog.getSaveFileName(self,"Save calculated PK concentrations",
+      output_filename, _ = QFileDialog.getSaveFileName(self,"Save calculated PK concentrations",
             "","csv files (*.csv);;", options=options)
-      try:
-        if '.csv' not in filename:
-          filename = filename + '.csv'
-        output_df.to_csv(filename)
-      except:
-        self.sudden_death("There was an error generating the output file. Data has not been saved.")
+      if not output_filename:
+        return
+      if '.csv' not in output_filename:
+        output_filename = output_filename + '.csv'
+      #The PK file is processed in chunks and written out as we go so very large files don't need to fit in memory,
+      #and it all happens in the background so the window stays usable.
+      pb_model = self.current_model
+      self.pk_output_filename = output_filename
+      self.start_task(lambda report: pk_calc.stream_pk_calculations(pb_model, filename, output_filename,
+                        progress_callback=lambda rows: report('pk', rows, 0), cancel_event=self.cancel_event),
+                      self.pk_calcs_finished)
+
+  def pk_calcs_finished(self, stats):
+    if isinstance(stats, Exception):
+      #stream_pk_calculations has already removed any partial output.
+      self.sudden_death("There was an error reading your file or generating the output. Are you sure there's no text "
+                        "in column 1? Are you SURE it's a csv? Nothing was saved.")
+      return
+    if stats['cancelled']:
+      #Don't leave a partial file lying around looking like a finished one.
+      if os.path.exists(self.pk_output_filename):
+        os.remove(self.pk_output_filename)
+      self.progress_label.setText('PK calculations cancelled; nothing saved.')
+      return
     alert = QMessageBox()
-    alert.setText("Congratulations! Your results are saved to %s"%filename)
-    alert.setIconPixmap(QPixmap(os.path.join('lib', 'success.jpg')))
+    alert.setText("Congratulations! Your results are saved to %s\n(%s rows at %.0f rows per second)"%(
+                  self.pk_output_filename, stats['rows'], stats['rows_per_second']))
+    alert.setIconPixmap(QPixmap(os.path.join(model_building.lib_dir, 'success.jpg')))
     alert.setWindowTitle('Protein Fitter')
     alert.exec_()
-        
+
 
 
   def save_model(self):
@@ -147,8 +205,7 @@ class protfitter(QMainWindow):
             "","MODEL Files (*.model);;", options=options)
     if filename:
       try:
-        with open('%s.model'%filename, 'wb') as output_model:
-          pickle.dump(self.current_model, output_model)
+        model_io.save_model(self.current_model, '%s.model'%filename)
       except:
         self.sudden_death('You are trying to overwrite an existing file or '
                           'save in an invalid location. Model not saved.')
@@ -160,8 +217,8 @@ class protfitter(QMainWindow):
             "","MODEL Files (*.model);;", options=options)
     if filename:
       try:
-        with open(filename, 'rb') as input_model:
-          self.current_model = pickle.load(input_model)
+        self.current_model = model_io.load_model(filename, load_training_data = True)
+        self.current_model.fit_cache = self.fit_cache
       except:
         self.sudden_death('There was an error loading the model you indicated. Try again, or check '
                           'to make sure you indicated a valid .mod file.')
@@ -219,22 +276,128 @@ class protfitter(QMainWindow):
     if self.current_model.associated_data is None:
       self.sudden_death("You want to fit the data, but you haven't loaded any? Try loading some first. Now there's an idea!")
       return
-    self.current_model.model_type = self.current_model_selection
-    self.current_model.weight_type = self.current_weight_selection
-    output_code = self.current_model.model_fit()
+    #We fit a new model in the background and only replace the current one if the fit succeeds, so a
+    #cancelled or failed fit leaves the last good model in place.
+    fitting_model = model_building.protbind_model(model_type = self.current_model_selection,
+                                                  weight_type = self.current_weight_selection)
+    fitting_model.associated_data = self.current_model.associated_data
+    fitting_model.excluded_points = self.current_model.excluded_points
+    fitting_model.plot_color = self.current_model.plot_color
+    fitting_model.plot_title = self.current_model.plot_title
+    fitting_model.fit_cache = self.fit_cache
+    fitting_model.instrumentation = True
+    fitting_model.cancel_event = self.cancel_event
+    self.fitting_model = fitting_model
+    def fit_job(report):
+      fitting_model.progress_callback = report
+      return fitting_model.model_fit()
+    self.start_task(fit_job, self.fit_finished)
+
+  #With the checkbox ticked, clicking a point in the plot takes it out of the fit (or puts it back) and the
+  #model is refitted starting from its current parameters (see refit in model_building.py), which only takes
+  #a moment. As with a full fit this is done on a copy of the model, so a failed refit leaves it as it was.
+  def toggle_point(self, event):
+    state = plotting.get_plot_state(self)
+    if not self.exclude_checkbox.isChecked() or self.current_task is not None or event.artist is not state.scatter:
+      return
+    data = self.current_model.associated_data
+    if data is None or state.data is None or not np.array_equal(state.data[0], data['total'].values):
+      self.sudden_death('Fit the dataset you have loaded before excluding points from it.')
+      return
+    index = event.ind[0]
+    fitting_model = copy.deepcopy(self.current_model)
+    excluded_points = fitting_model.excluded_points
+    fitting_model.exclude_points([index], excluded_points is None or not excluded_points[index])
+    fitting_model.fit_cache = self.fit_cache
+    fitting_model.instrumentation = True
+    fitting_model.cancel_event = self.cancel_event
+    self.fitting_model = fitting_model
+    def refit_job(report):
+      fitting_model.progress_callback = report
+      return fitting_model.refit()
+    self.start_task(refit_job, self.fit_finished)
+
+  def fit_finished(self, output_code):
+    self.fitting_model.progress_callback = None
+    self.fitting_model.cancel_event = None
+    if isinstance(output_code, Exception):
+      output_code = 'The fit failed with an unexpected error: %s'%output_code
     if output_code != '0':
-      self.sudden_death(output_code)
+      if self.cancel_event.is_set():
+        self.progress_label.setText('Fit cancelled.')
+      else:
+        self.sudden_death(output_code)
       return
     else:
-      plotting.gen_plot(self)
-      plotting.gen_residual_plot(self)
+      self.current_model = self.fitting_model
+      if self.current_model.fit_warning is not None:
+        alert = QMessageBox()
+        alert.setText(self.current_model.fit_warning)
+        alert.setWindowTitle('Protein Fitter')
+        alert.exec_()
+      with self.current_model.stage_timer('plotting'):
+        plotting.gen_plot(self)
+        plotting.gen_residual_plot(self)
+
+  #Runs job in a background_task and calls when_done with its result on the GUI thread.
+  def start_task(self, job, when_done):
+    self.cancel_event.clear()
+    for widget in self.task_widgets:
+      widget.setEnabled(False)
+    self.cancel_button.setEnabled(True)
+    self.progress_label.setText('Working...')
+    self.progress_bar.setRange(0, 0)
+    self.when_task_done = when_done
+    self.current_task = background_task(job)
+    self.current_task.progress.connect(self.show_progress)
+    self.current_task.finished_with.connect(self.task_finished)
+    self.current_task.start()
+
+  def task_finished(self, result):
+    self.current_task.wait()
+    self.current_task = None
+    for widget in self.task_widgets:
+      widget.setEnabled(True)
+    self.cancel_button.setEnabled(False)
+    self.progress_label.setText('')
+    self.progress_bar.setRange(0, 1)
+    self.progress_bar.reset()
+    self.when_task_done(result)
+
+  def show_progress(self, stage, done, total):
+    self.progress_label.setText(self.progress_stages[stage]%((done, total) if total > 0 else done))
+    if total > 0:
+      self.progress_bar.setRange(0, total)
+      self.progress_bar.setValue(done)
+    else:
+      self.progress_bar.setRange(0, 0)
+
+  def cancel_task(self):
+    self.cancel_event.set()
+    self.progress_label.setText('Cancelling...')
+
+  #Don't let the window close with a task still running in the background.
+  def closeEvent(self, event):
+    if self.current_task is not None:
+      self.cancel_event.set()
+      self.current_task.wait()
+    event.accept()
+
+  def show_timing_breakdown(self):
+    if self.current_model.fit_stats is None:
+      self.sudden_death('There is no timing information yet. Fit a model first!')
+      return
+    alert = QMessageBox()
+    alert.setText(self.current_model.fit_stats.report())
+    alert.setWindowTitle('Protein Fitter')
+    alert.exec_()
 
 
 
   def sudden_death(self, error_message):
     alert = QMessageBox()
     alert.setText(error_message)
-    alert.setIconPixmap(QPixmap(os.path.join('lib', 'failure.jpg')))
+    alert.setIconPixmap(QPixmap(os.path.join(model_building.lib_dir, 'failure.jpg')))
     alert.setWindowTitle('Sudden Death')
     alert.exec_()
 
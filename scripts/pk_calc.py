@@ -1,14 +1,110 @@
-import pandas as pd, numpy as np, model_building
-from PyQt5.QtWidgets import QFileDialog
-import matplotlib.pyplot as plt
+import pandas as pd, numpy as np, model_building, model_io, argparse, os, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+#Calculates free drug for a whole PK file at once (concentrations in the first column, no header, any other
+#columns ignored). Like make_preds this returns the result, here a DataFrame in the layout the GUI writes,
+#together with an error code which is '0' if all went well and an error message otherwise. For files too big
+#to hold in memory use stream_pk_calculations, and for many models and PK files at once see bulk_pk_calc.py.
 def pk_calculations(pb_model, file_to_load):
     try:
-        raw_inputs = pd.read_csv(file_to_load, header=None).values
-        x = np.asarray([float(z) for z in raw_inputs[:,0]])
-        y = pb_model.make_preds(x)
-        options = QFileDialog.Options()
-        filename, _ = QFileDialog.getSaveFileName(self,"Save model",
-                "","MODEL Files (*.model);;", options=options)
-    except:
-        return 'There was an error loading the selected file. Changes not saved.'
+        x = pd.read_csv(file_to_load, header=None, usecols=[0]).values[:,0].astype(float)
+    except Exception:
+        return None, 'There was an error loading the selected file. Are you sure there is no text in column 1?'
+    free_concentrations, error_code = pb_model.make_preds(x)
+    if error_code != '0':
+        return None, 'The model must be fitted or loaded before running PK calculations.'
+    return pd.DataFrame({'Total concentration':x, 'Free concentration':free_concentrations}), '0'
+
+
+#Calculates free drug for a single chunk of total concentrations. This is a module level function so it
+#can be sent to a process pool.
+def predict_chunk(pb_model, total_concentrations):
+    free_concentrations, error_code = pb_model.make_preds(total_concentrations)
+    if error_code != '0':
+        raise ValueError('The model must be fitted or loaded before running PK calculations.')
+    return free_concentrations
+
+
+#Streaming version of the PK calculation for very large PK files. The input (concentrations in the first
+#column, no header, any other columns ignored) is read chunk_size rows at a time, free drug is calculated
+#for each chunk and the results are appended to output_file as we go, so memory use depends on the chunk
+#size rather than the size of the file. The output has the same layout the GUI has always written. With
+#num_workers > 1 chunks are handed to a pool of threads (or processes if pool_type is 'process'); we only
+#keep a couple of chunks per worker in flight so the memory footprint stays bounded. progress_callback, if
+#given, is called with the number of rows done after each chunk. If cancel_event (a threading.Event) is set
+#we stop after the current chunk, leaving only the rows done so far in output_file, and stats['cancelled']
+#is True. If anything goes wrong once output_file has been opened the partial file is removed before the
+#error is raised again, so that a truncated output is never mistaken for a finished one. Returns some
+#statistics on the run.
+def stream_pk_calculations(pb_model, input_file, output_file, chunk_size = 100000, num_workers = 1,
+                           pool_type = 'thread', progress_callback = None, cancel_event = None):
+    start_time = time.time()
+    reader = pd.read_csv(input_file, header=None, usecols=[0], chunksize=chunk_size)
+    stats = {'rows':0, 'chunks':0, 'cancelled':False}
+    executor = None
+    if num_workers > 1:
+        executor = ThreadPoolExecutor(num_workers) if pool_type == 'thread' else ProcessPoolExecutor(num_workers)
+    output_opened = False
+    try:
+        with open(output_file, 'w', newline='') as output_handle:
+            output_opened = True
+            pending = []
+            for chunk in reader:
+                if cancel_event is not None and cancel_event.is_set():
+                    stats['cancelled'] = True
+                    break
+                total_concentrations = chunk.values[:,0].astype(float)
+                if executor is None:
+                    pending.append((total_concentrations, predict_chunk(pb_model, total_concentrations)))
+                else:
+                    pending.append((total_concentrations, executor.submit(predict_chunk, pb_model,
+                                                                          total_concentrations)))
+                while len(pending) > 2 * max(num_workers, 1) or (executor is None and pending):
+                    write_chunk(output_handle, pending.pop(0), stats, progress_callback)
+            while pending:
+                write_chunk(output_handle, pending.pop(0), stats, progress_callback)
+    except BaseException:
+        if output_opened and os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    stats['seconds'] = time.time() - start_time
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+def write_chunk(output_handle, pending_chunk, stats, progress_callback):
+    total_concentrations, free_concentrations = pending_chunk
+    if not isinstance(free_concentrations, np.ndarray):
+        free_concentrations = free_concentrations.result()
+    output_dict = {'Total concentration':total_concentrations, 'Free concentration':free_concentrations}
+    output_df = pd.DataFrame.from_dict(output_dict)
+    output_df.index = output_df.index + stats['rows']
+    output_df.to_csv(output_handle, header=(stats['chunks'] == 0))
+    stats['rows'] += total_concentrations.shape[0]
+    stats['chunks'] += 1
+    if progress_callback is not None:
+        progress_callback(stats['rows'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate free drug for a PK file using a saved model.')
+    parser.add_argument('model', help='A model saved from the GUI')
+    parser.add_argument('input', help='csv file with total concentrations in the first column and no header')
+    parser.add_argument('output', help='Where to write the calculated free concentrations')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Rows to read and calculate at a time')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers to spread chunks over')
+    parser.add_argument('--pool-type', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--lookup-range', type=float, nargs=2, metavar=('MIN', 'MAX'), default=None,
+                        help='Build a lookup table over this range of total concentrations for faster predictions')
+    args = parser.parse_args()
+    pb_model = model_io.load_model(args.model)
+    if args.lookup_range is not None:
+        max_error = pb_model.build_lookup_table(args.lookup_range[0], args.lookup_range[1])
+        print('Built lookup table with maximum relative error %.2g'%max_error)
+    stats = stream_pk_calculations(pb_model, args.input, args.output, args.chunk_size, args.workers,
+                                   args.pool_type)
+    print('Calculated free drug for %s rows in %.1f s (%.0f rows/s)'%(stats['rows'], stats['seconds'],
+                                                                    stats['rows_per_second']))
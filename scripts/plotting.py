@@ -1,15 +1,9 @@
-import numpy as np, matplotlib
-from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.figure import Figure
-from matplotlib.pyplot import cm
-import matplotlib.colors as colors
-import matplotlib.pyplot as plt
+import numpy as np
 
 
 def cell_text(qtapp):
-  num_params = qtapp.current_model.model_type * 2 + 2
-  labels = ['kd1', 'p1', 'kd2', 'p2'][0:num_params]
+  labels = qtapp.current_model.model_associated_params[qtapp.current_model.model_type]
+  num_params = len(labels)
   celltext = [[labels[i], calc_sig_figs(qtapp.current_model.params[i]),
                calc_sig_figs(qtapp.current_model.param_errors[i])]
               for i in range(0, num_params)]
@@ -22,47 +16,105 @@ def calc_sig_figs(parameter):
   return '{:g}'.format(float('{:.{p}g}'.format(parameter, p=num_sig_figs)))
   
 
+#The plots are built once and then kept, along with their artists (scatter, fitted line, parameter table and
+#the residual window), in a plot_state on the app. Redrawing after a new fit or a colour change only updates
+#the data, colour and text of the existing artists and asks the canvas for an idle redraw, rather than
+#clearing the figure and building everything again. The figure is rebuilt only if it is new or the parameter
+#table needs a different number of rows. Points excluded from the fit stay in the scatter, drawn hollow and
+#grey, so that they can be clicked to include them again.
+class plot_state:
+  def __init__(self, figure):
+    self.figure = figure
+    self.figure.clf()
+    self.ax = self.figure.add_subplot(121)
+    self.ax2 = self.figure.add_subplot(122)
+    self.ax.set_ylabel('Free drug concentration (micromolar)')
+    self.ax.set_xlabel('Total drug concentration (micromolar)')
+    self.ax.set_yscale('log')
+    self.ax.set_xscale('log')
+    self.scatter = self.ax.scatter([], [], color='k', s=1.0, picker=True)
+    self.line, = self.ax.plot([], [], linewidth=0.5)
+    self.ax2.axis('off')
+    self.ax2.set_title('Parameter estimates, associated error and other\nstatistics for current model')
+    self.table = None
+    self.data = None
+    self.residual_figure = None
+
+  def update_table(self, celltext):
+    if self.table is None or len(self.table.get_celld()) != 3 * (len(celltext) + 1):
+      if self.table is not None:
+        self.table.remove()
+      self.table = self.ax2.table(cellText = celltext, cellLoc='center', loc='center right',
+                                  colLabels = ['Parameter', 'Value', 'Uncertainty'],
+                                  colWidths=[0.33, 0.33, 0.33])
+      return
+    for row, row_text in enumerate(celltext):
+      for column, text in enumerate(row_text):
+        self.table[(row + 1, column)].get_text().set_text(text)
+
+  #Points and limits only change when the dataset or the prediction curve do, so we skip that work (which
+  #grows with the dataset) when only e.g. the colour has changed.
+  def update_data(self, xactual, yactual, xpredicted, ypredicted):
+    data = (xactual, yactual, xpredicted, ypredicted)
+    if self.data is not None and all(new is old or np.array_equal(new, old) for new, old in zip(data, self.data)):
+      return
+    self.data = data
+    self.scatter.set_offsets(np.column_stack((xactual, yactual)))
+    self.line.set_data(xpredicted, ypredicted)
+    self.ax.relim()
+    self.ax.update_datalim(np.column_stack((xactual, yactual)))
+    self.ax.autoscale_view()
+
+  def update_excluded(self, excluded_points, num_points):
+    excluded = np.zeros(num_points, dtype=bool) if excluded_points is None else excluded_points
+    self.scatter.set_facecolors(np.where(excluded[:, np.newaxis], (0, 0, 0, 0), (0, 0, 0, 1)))
+    self.scatter.set_edgecolors(np.where(excluded[:, np.newaxis], (0.5, 0.5, 0.5, 1), (0, 0, 0, 1)))
+    self.scatter.set_sizes(np.where(excluded, 12.0, 1.0))
+
+
+def get_plot_state(qtapp):
+  state = getattr(qtapp, 'plot_state', None)
+  if state is None or state.figure is not qtapp.central_plot:
+    state = plot_state(qtapp.central_plot)
+    qtapp.plot_state = state
+  return state
+
+
+#pyplot is only needed for the residual window, so it isn't imported until the first one is shown.
 def gen_residual_plot(qtapp):
-  popup_plot = plt.figure()
-  popup_ax = popup_plot.add_subplot(111)
+  import matplotlib.pyplot as plt
+  state = get_plot_state(qtapp)
   predicted_free, _ = qtapp.current_model.make_preds(qtapp.current_model.associated_data['total'].values)
   actual_free = qtapp.current_model.associated_data['free'].values
-  popup_ax.scatter(qtapp.current_model.input_x_values, 100*(1 - predicted_free / actual_free), marker = 'o',
-                     facecolors='None', edgecolors='red', s=8)
-  horizontal_array = np.arange(qtapp.current_model.input_x_values[0],qtapp.current_model.input_x_values[-1],1)
-  popup_ax.plot(horizontal_array, np.zeros((horizontal_array.shape[0])), color='black')
-  popup_ax.set_xscale('log')
-  popup_ax.set_title('Residuals as percent of actual for the current fit')
-  popup_ax.set_xlabel('Total drug concentration from model-associated dataset (ug/mL)')
-  popup_ax.set_ylabel('% error on predicted free drug')
-  popup_plot.show()
+  percent_error = 100*(1 - predicted_free / actual_free)
+  #Reuse the residual window unless the user has closed it.
+  if state.residual_figure is None or not plt.fignum_exists(state.residual_figure.number):
+    state.residual_figure = plt.figure()
+    popup_ax = state.residual_figure.add_subplot(111)
+    state.residual_scatter = popup_ax.scatter([], [], marker = 'o', facecolors='None', edgecolors='red', s=8)
+    popup_ax.axhline(0, color='black')
+    popup_ax.set_xscale('log')
+    popup_ax.set_title('Residuals as percent of actual for the current fit')
+    popup_ax.set_xlabel('Total drug concentration from model-associated dataset (ug/mL)')
+    popup_ax.set_ylabel('% error on predicted free drug')
+  popup_ax = state.residual_figure.axes[0]
+  total = qtapp.current_model.associated_data['total'].values
+  state.residual_scatter.set_offsets(np.column_stack((total, percent_error)))
+  popup_ax.relim()
+  popup_ax.update_datalim(np.column_stack((total, percent_error)))
+  popup_ax.autoscale_view()
+  state.residual_figure.show()
+  state.residual_figure.canvas.draw_idle()
 
 
 def gen_plot(qtapp, generate_residual_popup_plot = False):
-  qtapp.central_plot.clf()
-  ax = qtapp.central_plot.add_subplot(121)
-  ax2 = qtapp.central_plot.add_subplot(122)
-  ax2.clear()
-  ax.clear()
-
-  ax.set_ylabel('Free drug concentration (micromolar)')
-  ax.set_xlabel('Total drug concentration (micromolar)')
-  ax.set_yscale('log')
-  ax.set_xscale('log')
-
-  xactual = qtapp.current_model.associated_data['total'].values
-  yactual = qtapp.current_model.associated_data['free'].values
-  ypredicted = qtapp.current_model.predicted_free
-
-  ax.scatter(xactual, yactual, color='k', s=1.0)
-  ax.plot(qtapp.current_model.x_values_spanning_range, qtapp.current_model.predicted_free, 
-      color=qtapp.current_model.plot_color, linewidth=0.5)
-  ax2.axis('off')
-  ax2.table(cellText = cell_text(qtapp), cellLoc='center', loc='center right',
-            colLabels = ['Parameter', 'Value', 'Uncertainty'],
-            colWidths=[0.33, 0.33, 0.33])
-  ax2.set_title('Parameter estimates, associated error and other\nstatistics for current model')
-  if qtapp.current_model.plot_title is not None:
-                ax.set_title(qtapp.current_model.plot_title)
-  qtapp.canvas.draw()
+  state = get_plot_state(qtapp)
+  state.update_data(qtapp.current_model.associated_data['total'].values,
+                    qtapp.current_model.associated_data['free'].values,
+                    qtapp.current_model.x_values_spanning_range, qtapp.current_model.predicted_free)
+  state.update_excluded(qtapp.current_model.excluded_points, qtapp.current_model.associated_data.shape[0])
+  state.line.set_color(qtapp.current_model.plot_color)
+  state.update_table(cell_text(qtapp))
+  state.ax.set_title(qtapp.current_model.plot_title if qtapp.current_model.plot_title is not None else '')
+  qtapp.canvas.draw_idle()
   return '0'
@@ -0,0 +1,112 @@
+import numpy as np
+
+#Pure NumPy solver for the free drug concentration in a model with any number of independent binding
+#sites. For total drug x, binding capacities p_i and dissociation constants kd_i, free drug F satisfies
+#
+#   h(F) = F + sum_i p_i * F / (kd_i + F) - x = 0
+#
+#which after clearing denominators is the cubic (two sites) / quartic (three sites) the C++ rootfinder
+#solves through a companion matrix eigendecomposition one row at a time. h is strictly increasing and
+#concave on F > 0 with h(0) = -x and h(x) >= 0, so there is exactly one root in (0, x], and Newton's
+#method started to the left of the root climbs to it monotonically. We therefore start from a guaranteed
+#lower bound (or a warm start from the previous call). A Newton step from a point to the right of the
+#root lands to the left of it (again by concavity), so the only safeguard needed is to never step below
+#the lower bound. Everything is done on whole arrays at once so there is no per-row overhead, and x / kd
+#/ p may be any mutually broadcastable shapes (e.g. a matrix of parameter sets against a vector of
+#concentrations).
+
+
+#Returns h(F) and dh/dF for the binding equation above.
+def binding_residual(free, x, kds, ps):
+  h = free - x
+  dh = np.ones_like(free)
+  for kd, p in zip(kds, ps):
+    denominator = kd + free
+    h = h + p * free / denominator
+    dh = dh + p * kd / (denominator * denominator)
+  return h, dh
+
+
+def solve_free_drug(x, kds, ps, initial_guess = None, rel_tol = 1e-13, max_iter = 100):
+  x = np.asarray(x, dtype=np.float64)
+  kds = [np.asarray(kd, dtype=np.float64) for kd in kds]
+  ps = [np.asarray(p, dtype=np.float64) for p in ps]
+  shape = np.broadcast(x, *(kds + ps)).shape
+  x = np.broadcast_to(x, shape)
+  #Both of these are points where h <= 0: x - sum(p) because each site binds at most p_i, and
+  #x / h'(0) because h is concave so its tangent at zero lies above it.
+  total_capacity = np.zeros(shape)
+  initial_slope = np.ones(shape)
+  for kd, p in zip(kds, ps):
+    total_capacity = total_capacity + p
+    initial_slope = initial_slope + p / kd
+  lower = np.clip(np.maximum(x - total_capacity, x / initial_slope), 0.0, None)
+  if initial_guess is None:
+    free = lower
+  else:
+    free = np.clip(np.asarray(initial_guess, dtype=np.float64), lower, x)
+  for _ in range(max_iter):
+    h, dh = binding_residual(free, x, kds, ps)
+    new_free = np.maximum(free - h / dh, lower)
+    converged = np.all(np.abs(new_free - free) <= rel_tol * new_free)
+    free = new_free
+    if converged:
+      break
+  return free
+
+
+#Slope of free drug with respect to total drug at the root, dF/dx = 1 / (dh/dF).
+def free_drug_slope(free, kds, ps):
+  dh = np.ones_like(free)
+  for kd, p in zip(kds, ps):
+    denominator = kd + free
+    dh = dh + p * kd / (denominator * denominator)
+  return 1.0 / dh
+
+
+#Sensitivities of the free drug root to the parameters, by implicit differentiation of h(F) = 0:
+#dF/dtheta = -(dh/dtheta) / (dh/dF). Returns a list with (dF/dkd_i, dF/dp_i) for each site.
+def free_drug_sensitivities(free, kds, ps):
+  dh = np.ones_like(free)
+  for kd, p in zip(kds, ps):
+    denominator = kd + free
+    dh = dh + p * kd / (denominator * denominator)
+  sensitivities = []
+  for kd, p in zip(kds, ps):
+    denominator = kd + free
+    sensitivities.append((p * free / (denominator * denominator * dh), -free / (denominator * dh)))
+  return sensitivities
+
+
+#Second derivatives of the free drug root with respect to the parameters, ordered kd1, p1, kd2, p2, ...
+#Differentiating h(F(theta), theta) = 0 twice gives
+#   F_ij = -(h_FF F_i F_j + h_Fi F_j + h_Fj F_i + h_ij) / h_F
+#and the only nonzero h_ij are between the kd and p of the same site. Returns an array with two extra
+#trailing dimensions holding the (num_params x num_params) matrix for each concentration.
+def free_drug_second_derivatives(free, kds, ps):
+  num_params = 2 * len(kds)
+  dh = np.ones_like(free)
+  d2h = np.zeros_like(free)
+  first_derivatives, cross_derivatives = [], []
+  for kd, p in zip(kds, ps):
+    denominator = kd + free
+    dh = dh + p * kd / denominator**2
+    d2h = d2h - 2 * p * kd / denominator**3
+    cross_derivatives += [p * (free - kd) / denominator**3, kd / denominator**2]
+  for dkd, dp in free_drug_sensitivities(free, kds, ps):
+    first_derivatives += [dkd, dp]
+  second_derivatives = np.zeros(free.shape + (num_params, num_params))
+  for i in range(num_params):
+    for j in range(i, num_params):
+      numerator = (d2h * first_derivatives[i] * first_derivatives[j] + cross_derivatives[i] * first_derivatives[j]
+                   + cross_derivatives[j] * first_derivatives[i])
+      if i // 2 == j // 2:
+        kd, p = kds[i // 2], ps[i // 2]
+        denominator = kd + free
+        if i == j and i % 2 == 0:
+          numerator = numerator + 2 * p * free / denominator**3
+        elif i != j:
+          numerator = numerator - free / denominator**2
+      second_derivatives[..., i, j] = -numerator / dh
+      second_derivatives[..., j, i] = second_derivatives[..., i, j]
+  return second_derivatives